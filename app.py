@@ -5,18 +5,44 @@ import glob
 import re
 import numpy as np
 import json
-import gdown
 import tempfile
+import io
+import zipfile
+import tarfile
+import uuid
+import hmac
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Keras
-from keras.models import load_model
-from keras.preprocessing import image
+import tensorflow as tf
 
 # Flask utils
 from flask import Flask, redirect, url_for, request, render_template, jsonify
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
 from gevent.pywsgi import WSGIServer
 
+from labels import CLASS_NAMES, LabelIndex
+from knowledge_base import DiseaseKnowledgeBase
+from confidence import load_temperature, calibrate, top_k
+from quality import check_quality, ImageRejected
+from preprocessing import preprocess_image, DecodePool, IMAGE_EXTENSIONS
+from tiling import decode_tiled, tile_views, select_tiles, summarize
+from augment import tta_views, VIEWS as TTA_VIEW_NAMES
+from vector_index import VectorIndex
+from backends import load_backend, BACKENDS
+from batching import BatchScheduler
+from cache import PredictionCache, content_key, perceptual_key, shared_tier_from_url
+from model_store import ModelStore, check_version
+from model_registry import ModelRegistry, ModelVersion
+from http_cache import CachedResource
+from metrics import Registry, SIZE_BUCKETS
+from jobs import JobManager, MemoryJobStore, SQLiteJobStore, QueueFull
+from tracing import Tracer, exporter_from_config, record_exception
+from uploads import guarded_request_class, read_image, check_image
+
 # Define a flask app
 app = Flask(__name__)
 
@@ -25,864 +51,288 @@ app = Flask(__name__)
 # The ID is: 1ZTnZx0E_-U55PVkhOL6DK8KuYP_FUQhl
 MODEL_ID = "1ZTnZx0E_-U55PVkhOL6DK8KuYP_FUQhl"
 
-# Create a temporary directory to store the downloaded model
+# Local model cache: the model is only downloaded when it is missing or fails
+# its checksum. MODEL_SHA256 pins the expected digest and MODEL_OFFLINE=1
+# boots from the cache without ever touching the network.
 TEMP_DIR = tempfile.gettempdir()
-MODEL_PATH = os.path.join(TEMP_DIR, 'plant_disease_model.h5')
-
-# Disease information database (your existing DISEASE_INFO dictionary remains the same)
-DISEASE_INFO = {
-    'Apple___Apple_scab': {
-        'causes': [
-            'Fungus Venturia inaequalis',
-            'Infected plant debris',
-            'Moist, humid weather conditions',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Plant resistant varieties',
-            'Remove infected leaves and debris',
-            'Prune for better air circulation',
-            'Avoid overhead irrigation'
-        ],
-        'pesticides': [
-            {'name': 'Captan', 'application': 'Spray before flowering'},
-            {'name': 'Mancozeb', 'application': 'Apply every 7-14 days during wet conditions'},
-            {'name': 'Propiconazole', 'application': 'Use as a preventive treatment'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-70°F (15-21°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during spring',
-            'seasonality': 'Spring through early summer'
-        },
-        'occurrence_pattern': 'Common in humid regions, particularly during wet springs',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Apple___Black_rot': {
-        'causes': [
-            'Fungus Diplocarpon mali',
-            'Infected plant debris',
-            'Wet and humid conditions',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Remove fallen fruit and infected leaves',
-            'Use resistant apple varieties',
-            'Improve air circulation',
-            'Avoid overhead irrigation'
-        ],
-        'pesticides': [
-            {'name': 'Mancozeb', 'application': 'Use preventatively during wet weather'},
-            {'name': 'Myclobutanil', 'application': 'Apply at early bloom'},
-            {'name': 'Captan', 'application': 'Use during critical growth stages'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-75°F (15-24°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during spring',
-            'seasonality': 'Spring through fall'
-        },
-        'occurrence_pattern': 'More severe in wet seasons, common in commercial orchards',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Apple___Cedar_apple_rust': {
-        'causes': [
-            'Fungus Gymnosporangium juniperi-virginianae',
-            'Infection requires both apple and cedar trees',
-            'Moisture and humidity',
-            'Wind dispersal of spores'
-        ],
-        'prevention': [
-            'Plant resistant apple varieties',
-            'Remove cedar trees near apple orchards',
-            'Improve air circulation',
-            'Avoid overhead irrigation'
-        ],
-        'pesticides': [
-            {'name': 'Chlorothalonil', 'application': 'Spray at bud break'},
-            {'name': 'Mancozeb', 'application': 'Use every 7-14 days during spring'},
-            {'name': 'Propiconazole', 'application': 'Use for control in early season'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-75°F (15-24°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rains during spring',
-            'seasonality': 'Spring through summer'
-        },
-        'occurrence_pattern': 'Common in areas with both cedar and apple trees',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Apple___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-75°F (15-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Blueberry___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Cherry_(including_sour)___Powdery_mildew': {
-        'causes': [
-            'Fungus Podosphaera clandestina',
-            'High humidity',
-            'Poor air circulation',
-            'Warm temperatures'
-        ],
-        'prevention': [
-            'Improve air circulation',
-            'Avoid overhead watering',
-            'Remove infected plant debris',
-            'Use resistant cherry varieties'
-        ],
-        'pesticides': [
-            {'name': 'Sulfur', 'application': 'Apply at first sign of infection'},
-            {'name': 'Myclobutanil', 'application': 'Use preventatively every 10-14 days'},
-            {'name': 'Trifloxystrobin', 'application': 'Use as needed'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Regular moisture required',
-            'seasonality': 'Spring through summer'
-        },
-        'occurrence_pattern': 'Common in humid areas, particularly during warm weather',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Cherry_(including_sour)___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Corn_(maize)___Cercospora_leaf_spot Gray_leaf_spot': {
-        'causes': [
-            'Fungus Cercospora zeae-maydis',
-            'Warm, humid conditions',
-            'Infected plant debris',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Practice crop rotation',
-            'Remove infected debris',
-            'Improve air circulation',
-            'Use resistant maize varieties'
-        ],
-        'pesticides': [
-            {'name': 'Azoxystrobin', 'application': 'Use preventatively in susceptible fields'},
-            {'name': 'Chlorothalonil', 'application': 'Spray every 10-14 days as needed'},
-            {'name': 'Mancozeb', 'application': 'Use according to label instructions'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during summer',
-            'seasonality': 'Summer through fall'
-        },
-        'occurrence_pattern': 'Common in humid regions; can be severe during wet seasons',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Corn_(maize)___Common_rust_': {
-        'causes': [
-            'Fungus Puccinia sorghi',
-            'Windborne spores',
-            'High humidity',
-            'Warm temperatures'
-        ],
-        'prevention': [
-            'Plant resistant maize varieties',
-            'Practice crop rotation',
-            'Avoid overhead irrigation',
-            'Remove volunteer maize plants'
-        ],
-        'pesticides': [
-            {'name': 'Azoxystrobin', 'application': 'Use as a preventive spray'},
-            {'name': 'Chlorothalonil', 'application': 'Apply during early infection stages'},
-            {'name': 'Triazole fungicides', 'application': 'Use when rust is detected'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during summer',
-            'seasonality': 'Summer through fall'
-        },
-        'occurrence_pattern': 'Common in many regions; severity depends on weather',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Corn_(maize)___Northern_Leaf_Blight': {
-        'causes': [
-            'Fungus Exserohilum turcicum',
-            'Infected plant debris',
-            'Warm, wet conditions',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Practice crop rotation',
-            'Remove infected debris',
-            'Improve air circulation',
-            'Use resistant maize varieties'
-        ],
-        'pesticides': [
-            {'name': 'Azoxystrobin', 'application': 'Use as needed during disease outbreaks'},
-            {'name': 'Mancozeb', 'application': 'Use preventatively as needed'},
-            {'name': 'Propiconazole', 'application': 'Apply at early signs of infection'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-80°F (21-27°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during summer',
-            'seasonality': 'Summer through fall'
-        },
-        'occurrence_pattern': 'Common in humid areas; severity varies by year',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Corn_(maize)___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Grape___Black_rot': {
-        'causes': [
-            'Fungus Guignardia bidwellii',
-            'Warm, humid conditions',
-            'Infected plant debris',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Remove infected leaves and debris',
-            'Use resistant grape varieties',
-            'Improve air circulation in vineyards',
-            'Avoid overhead irrigation'
-        ],
-        'pesticides': [
-            {'name': 'Mancozeb', 'application': 'Use preventatively during wet conditions'},
-            {'name': 'Myclobutanil', 'application': 'Spray every 7-10 days if needed'},
-            {'name': 'Copper-based fungicides', 'application': 'Apply at bud break'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during summer',
-            'seasonality': 'Summer through fall'
-        },
-        'occurrence_pattern': 'Common in humid regions; severity increases with wet weather',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Grape___Esca_(Black_Measles)': {
-        'causes': [
-            'Fungus Phaeoacremonium spp. and other fungi',
-            'Infection through pruning wounds',
-            'Warm, humid weather',
-            'Aging vines'
-        ],
-        'prevention': [
-            'Prune in dry weather',
-            'Use resistant grape varieties',
-            'Improve vineyard sanitation',
-            'Monitor vine health'
-        ],
-        'pesticides': [
-            {'name': 'Copper-based fungicides', 'application': 'Use preventatively as needed'},
-            {'name': 'Chlorothalonil', 'application': 'Apply at first sign of infection'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Summer through fall'
-        },
-        'occurrence_pattern': 'Common in vineyards, especially older vines',
-        'severity_level': 'High'
-    },
-    
-    'Grape___Leaf_blight_(Isariopsis_Leaf_Spot)': {
-        'causes': [
-            'Fungus Isariopsis spp.',
-            'Warm, humid conditions',
-            'Infected plant debris',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Remove infected leaves and debris',
-            'Practice crop rotation',
-            'Improve air circulation in vineyards',
-            'Use resistant grape varieties'
-        ],
-        'pesticides': [
-            {'name': 'Mancozeb', 'application': 'Use preventatively during wet weather'},
-            {'name': 'Chlorothalonil', 'application': 'Spray every 10-14 days if needed'},
-            {'name': 'Copper-based fungicides', 'application': 'Use as per label instructions'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Late spring to early fall'
-        },
-        'occurrence_pattern': 'Common in humid regions; can be severe in wet years',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Grape___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Orange___Huanglongbing_(Citrus_greening)': {
-        'causes': [
-            'Bacteria Candidatus Liberibacter spp.',
-            'Spread by Asian citrus psyllid',
-            'Nutrient deficiencies',
-            'Stress from drought or flooding'
-        ],
-        'prevention': [
-            'Control psyllid populations',
-            'Remove infected trees',
-            'Maintain healthy soil',
-            'Implement good cultural practices'
-        ],
-        'pesticides': [
-            {'name': 'Imidacloprid', 'application': 'Use for psyllid control'},
-            {'name': 'Thiamethoxam', 'application': 'Use as needed'},
-            {'name': 'Bifenthrin', 'application': 'Use for psyllid control'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-85°F (18-29°C)',
-            'humidity': 'Variable',
-            'rainfall': 'Depends on region',
-            'seasonality': 'Year-round threat'
-        },
-        'occurrence_pattern': 'Endemic in citrus-growing regions; severe impact on production',
-        'severity_level': 'Very High'
-    },
-    
-    'Peach___Bacterial_spot': {
-        'causes': [
-            'Bacteria Xanthomonas arboricola pv. pruni',
-            'Wet weather conditions',
-            'Infected plant debris',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Remove infected plant debris',
-            'Practice crop rotation',
-            'Improve air circulation',
-            'Use resistant peach varieties'
-        ],
-        'pesticides': [
-            {'name': 'Copper-based bactericides', 'application': 'Spray preventatively before bloom'},
-            {'name': 'Streptomycin', 'application': 'Use as needed for severe infections'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-80°F (15-27°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Spring through summer'
-        },
-        'occurrence_pattern': 'Common in humid regions; can be severe in wet years',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Peach___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Pepper,_bell___Bacterial_spot': {
-        'causes': [
-            'Bacteria Xanthomonas campestris pv. vesicatoria',
-            'Wet weather conditions',
-            'Infected plant debris',
-            'Insect damage'
-        ],
-        'prevention': [
-            'Practice crop rotation',
-            'Remove infected plant debris',
-            'Improve air circulation',
-            'Use resistant pepper varieties'
-        ],
-        'pesticides': [
-            {'name': 'Copper-based bactericides', 'application': 'Use preventatively before bloom'},
-            {'name': 'Streptomycin', 'application': 'Use as needed for severe infections'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Spring through summer'
-        },
-        'occurrence_pattern': 'Common in humid regions; severity increases with wet weather',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Pepper,_bell___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Potato___Early_blight': {
-        'causes': [
-            'Fungus Alternaria solani',
-            'Infected plant debris',
-            'Warm, humid conditions',
-            'Poor air circulation'
-        ],
-        'prevention': [
-            'Practice crop rotation',
-            'Remove infected plant debris',
-            'Improve air circulation',
-            'Use resistant potato varieties'
-        ],
-        'pesticides': [
-            {'name': 'Chlorothalonil', 'application': 'Use preventatively during growing season'},
-            {'name': 'Mancozeb', 'application': 'Apply every 7-10 days as needed'},
-            {'name': 'Azoxystrobin', 'application': 'Use when conditions are favorable for blight'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-80°F (21-27°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Spring through fall'
-        },
-        'occurrence_pattern': 'Common in humid areas; severity increases with wet weather',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Potato___Late_blight': {
-        'causes': [
-            'Fungus Phytophthora infestans',
-            'Infected plant debris',
-            'Cool, moist conditions',
-            'High humidity'
-        ],
-        'prevention': [
-            'Practice crop rotation',
-            'Remove infected plant debris',
-            'Improve air circulation',
-            'Use resistant potato varieties'
-        ],
-        'pesticides': [
-            {'name': 'Metalaxyl', 'application': 'Use preventatively'},
-            {'name': 'Chlorothalonil', 'application': 'Apply every 7-10 days as needed'},
-            {'name': 'Mancozeb', 'application': 'Use as needed when conditions are favorable'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-70°F (15-21°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Spring through fall'
-        },
-        'occurrence_pattern': 'Common in humid and cool areas; can devastate crops',
-        'severity_level': 'Very High'
-    },
-    
-    'Potato___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Raspberry___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Soybean___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Squash___Powdery_mildew': {
-        'causes': [
-            'Fungus Podosphaera xanthii',
-            'High humidity',
-            'Poor air circulation',
-            'Warm temperatures'
-        ],
-        'prevention': [
-            'Improve air circulation',
-            'Avoid overhead watering',
-            'Remove infected plant debris',
-            'Use resistant squash varieties'
-        ],
-        'pesticides': [
-            {'name': 'Sulfur', 'application': 'Apply at first sign of infection'},
-            {'name': 'Myclobutanil', 'application': 'Use preventatively every 10-14 days'},
-            {'name': 'Trifloxystrobin', 'application': 'Use as needed'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'High',
-            'rainfall': 'Regular moisture required',
-            'seasonality': 'Spring through summer'
-        },
-        'occurrence_pattern': 'Common in humid areas; particularly severe in late summer',
-        'severity_level': 'Moderate to High'
-    },
-    
-    'Strawberry___Leaf_scorch': {
-        'causes': [
-            'Environmental stress',
-            'Excessive heat',
-            'Drought conditions',
-            'Fungal infections'
-        ],
-        'prevention': [
-            'Provide adequate water',
-            'Mulch to retain moisture',
-            'Avoid planting in hot, dry areas',
-            'Use resistant strawberry varieties'
-        ],
-        'pesticides': [
-            {'name': 'Fungicides for associated fungal infections', 'application': 'Use as needed'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-80°F (21-27°C)',
-            'humidity': 'Low',
-            'rainfall': 'Infrequent',
-            'seasonality': 'Summer through early fall'
-        },
-        'occurrence_pattern': 'Common during hot, dry summers; severity varies',
-        'severity_level': 'Moderate'
-    },
-    
-    'Strawberry___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-    
-    'Tomato___Blossom_end_rot': {
-        'causes': [
-            'Calcium deficiency',
-            'Irregular watering practices',
-            'Poor soil drainage',
-            'Excessive nitrogen'
-        ],
-        'prevention': [
-            'Maintain consistent watering schedule',
-            'Ensure adequate calcium in soil',
-            'Improve drainage',
-            'Avoid over-fertilization'
-        ],
-        'pesticides': [
-            {'name': 'None required for nutrient deficiency', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '70-85°F (21-29°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Summer through fall'
-        },
-        'occurrence_pattern': 'Common in hot, dry conditions; severity varies',
-        'severity_level': 'Moderate'
-    },
-    
-    'Tomato___Late_blight': {
-        'causes': [
-            'Fungus Phytophthora infestans',
-            'Infected plant debris',
-            'Cool, moist conditions',
-            'High humidity'
-        ],
-        'prevention': [
-            'Practice crop rotation',
-            'Remove infected plant debris',
-            'Improve air circulation',
-            'Use resistant tomato varieties'
-        ],
-        'pesticides': [
-            {'name': 'Metalaxyl', 'application': 'Use preventatively'},
-            {'name': 'Chlorothalonil', 'application': 'Apply every 7-10 days as needed'},
-            {'name': 'Mancozeb', 'application': 'Use as needed when conditions are favorable'}
-        ],
-        'weather_conditions': {
-            'temperature': '60-70°F (15-21°C)',
-            'humidity': 'High',
-            'rainfall': 'Frequent rain during growing season',
-            'seasonality': 'Spring through fall'
-        },
-        'occurrence_pattern': 'Common in humid and cool areas; can devastate crops',
-        'severity_level': 'Very High'
-    },
-    
-    'Tomato___healthy': {
-        'causes': [
-            'Healthy plants with no visible diseases',
-            'Proper care and maintenance',
-            'Good soil health',
-            'Appropriate watering practices'
-        ],
-        'prevention': [
-            'Regular monitoring for pests',
-            'Maintain proper spacing between plants',
-            'Implement crop rotation',
-            'Ensure good drainage'
-        ],
-        'pesticides': [
-            {'name': 'None required for healthy plants', 'application': 'N/A'}
-        ],
-        'weather_conditions': {
-            'temperature': '65-75°F (18-24°C)',
-            'humidity': 'Moderate',
-            'rainfall': 'Adequate but not excessive',
-            'seasonality': 'Year-round care needed'
-        },
-        'occurrence_pattern': 'Consistent health with proper care',
-        'severity_level': 'N/A'
-    },
-}
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(TEMP_DIR, 'plant_disease_models'))
+MODEL_SHA256 = os.environ.get('MODEL_SHA256') or None
+MODEL_OFFLINE = os.environ.get('MODEL_OFFLINE', '0') == '1'
+# Serve a local .h5 as-is instead of fetching MODEL_ID (benchmarks, development)
+MODEL_FILE = os.environ.get('MODEL_FILE', '')
+
+# TensorFlow thread pools per worker process. By default the cores are split
+# evenly between the WEB_CONCURRENCY worker processes so they don't oversubscribe.
+WORKER_PROCESSES = int(os.environ.get('WEB_CONCURRENCY', 1))
+TF_INTRA_OP_THREADS = int(os.environ.get('TF_INTRA_OP_THREADS', max(1, (os.cpu_count() or 1) // WORKER_PROCESSES)))
+TF_INTER_OP_THREADS = int(os.environ.get('TF_INTER_OP_THREADS', 2))
+
+# Inference backend: keras (the .h5 as-is), keras-mmap, tflite-dynamic, tflite-int8
+# or onnx. The non-keras artifacts are produced next to the .h5 by convert_model.py;
+# keras-mmap, the one to use with several worker processes (see gunicorn.conf.py),
+# is exported automatically the first time a version is loaded.
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'keras')
+
+# Batch sizes the inference function is compiled and warmed up for at startup
+INFERENCE_BATCH_SIZES = [int(n) for n in os.environ.get('INFERENCE_BATCH_SIZES', '1,8,32').split(',')]
+
+# Micro-batching: concurrent /predict requests are coalesced into one forward
+# pass of up to BATCH_MAX_SIZE images, waiting at most BATCH_MAX_WAIT_MS
+BATCH_ENABLED = os.environ.get('BATCH_ENABLED', '1') == '1'
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 32))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 10))
+
+# /predict/batch: maximum images per request and decode threads
+BATCH_UPLOAD_MAX_FILES = int(os.environ.get('BATCH_UPLOAD_MAX_FILES', 256))
+
+# Decode/resize runs on its own pool of DECODE_WORKERS threads (or processes
+# with DECODE_POOL=process), sized independently of TensorFlow's threads, and
+# feeds the batching scheduler through a queue of at most INFERENCE_QUEUE_SIZE
+# waiting requests
+DECODE_WORKERS = int(os.environ.get('DECODE_WORKERS', 4))
+DECODE_POOL = os.environ.get('DECODE_POOL', 'thread')
+INFERENCE_QUEUE_SIZE = int(os.environ.get('INFERENCE_QUEUE_SIZE', 256))
+
+# Uploads are decoded straight from memory; set ARCHIVE_UPLOADS=1 to also
+# keep a copy of each upload in ARCHIVE_DIR (written in the background)
+ARCHIVE_UPLOADS = os.environ.get('ARCHIVE_UPLOADS', '0') == '1'
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+
+# Prediction cache keyed by a hash of the upload bytes. CACHE_SHARED_URL adds a
+# tier shared by all workers: a directory path (or file://...) or redis://...
+# A directory tier keeps at most CACHE_SHARED_MAX_ENTRIES files, oldest pruned first.
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '1') == '1'
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 3600))
+CACHE_SHARED_URL = os.environ.get('CACHE_SHARED_URL', '')
+CACHE_SHARED_MAX_ENTRIES = int(os.environ.get('CACHE_SHARED_MAX_ENTRIES', 100000))
+CACHE_PHASH = os.environ.get('CACHE_PHASH', '0') == '1'
+
+# Responses carry the TOP_K most likely classes (overridable per request with
+# ?top_k=), with probabilities temperature-scaled by CALIBRATION_FILE if set.
+# Predictions below UNCERTAIN_THRESHOLD are flagged as uncertain.
+TOP_K = int(os.environ.get('TOP_K', 3))
+CALIBRATION_FILE = os.environ.get('CALIBRATION_FILE', '')
+UNCERTAIN_THRESHOLD = float(os.environ.get('UNCERTAIN_THRESHOLD', 0.5))
+
+# Blur/exposure/no-leaf pre-check that rejects unusable photos before inference
+QUALITY_CHECK = os.environ.get('QUALITY_CHECK', '1') == '1'
+
+# Test-time augmentation: /predict averages the softmax over TTA_VIEWS flipped
+# and cropped views of the image (overridable per request with ?tta=, 1 turns
+# it off), all run as one batch
+TTA_VIEWS = int(os.environ.get('TTA_VIEWS', 1))
+
+# /predict/tiled: large field and drone photos are cut into overlapping
+# 224x224 tiles (TILE_OVERLAP of a tile, overridable per request with
+# ?overlap=), scaled down if needed to at most TILE_MAX_TILES tiles. Tiles with
+# less than TILE_MIN_LEAF_FRACTION leaf-like pixels are skipped as background,
+# and a disease is diagnosed once it covers TILE_DISEASE_COVERAGE of the rest.
+TILE_OVERLAP = float(os.environ.get('TILE_OVERLAP', 0.25))
+TILE_MAX_TILES = int(os.environ.get('TILE_MAX_TILES', 256))
+TILE_MIN_LEAF_FRACTION = float(os.environ.get('TILE_MIN_LEAF_FRACTION', 0.15))
+TILE_DISEASE_COVERAGE = float(os.environ.get('TILE_DISEASE_COVERAGE', 0.05))
+if TILE_MAX_TILES < 1:
+    raise ValueError(f'TILE_MAX_TILES must be at least 1, not {TILE_MAX_TILES}')
+
+# Uploads are validated while they stream in. Requests over MAX_CONTENT_LENGTH
+# bytes and images over MAX_IMAGE_BYTES are refused with 413, files that aren't
+# images with 415, and images over MAX_IMAGE_PIXELS (decompression bombs) with
+# 413 as soon as their header has arrived, before anything is decoded.
+MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 64 * 1024 * 1024))
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 16 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 100_000_000))
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# Total image bytes one batch request may hold, uploaded files and extracted
+# archive members together; members are never read past this budget
+BATCH_UPLOAD_MAX_BYTES = int(os.environ.get('BATCH_UPLOAD_MAX_BYTES', MAX_CONTENT_LENGTH))
+app.request_class = guarded_request_class(MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS,
+                                          batch_endpoints=('upload_batch', 'create_job'))
+
+# Per-stage timings are always recorded in /metrics; with TIMING_HEADER=1 they
+# are also attached to each /predict response as a Server-Timing header
+TIMING_HEADER = os.environ.get('TIMING_HEADER', '0') == '1'
+
+# Request tracing. Every request records spans, but only head-sampled traces
+# (TRACING_SAMPLE_RATIO, or an incoming traceparent's sampled flag), requests
+# slower than TRACING_SLOW_MS and failed requests are exported. TRACING_EXPORTER
+# is console (JSON lines on stdout), jsonl (appended to TRACING_FILE), otlp
+# (OTLP/HTTP to OTEL_EXPORTER_OTLP_ENDPOINT) or none; it defaults to otlp when
+# that endpoint is set and console otherwise.
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'otlp' if os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT') else 'console')
+TRACING_FILE = os.environ.get('TRACING_FILE', 'traces.jsonl')
+TRACING_SAMPLE_RATIO = float(os.environ.get('TRACING_SAMPLE_RATIO', 0.01))
+TRACING_SLOW_MS = float(os.environ.get('TRACING_SLOW_MS', 1000))
 
+# Async jobs (POST /jobs): JOBS_WORKERS threads drain a queue of at most
+# JOBS_MAX_QUEUE waiting jobs. Set JOBS_DB to a SQLite file to keep queued
+# jobs across restarts; finished jobs are kept for JOBS_TTL seconds. Without
+# JOBS_DB jobs live in one worker process's memory, so with WEB_CONCURRENCY > 1
+# GET /jobs/<id> only finds a job on the worker that accepted it: set JOBS_DB
+# (shared by all workers) whenever more than one worker runs. A worker holds a
+# JOBS_LEASE-second lease on each job it runs, renewed while it runs; jobs are
+# only re-run by another worker once their lease has run out.
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+JOBS_MAX_QUEUE = int(os.environ.get('JOBS_MAX_QUEUE', 100))
+JOBS_DB = os.environ.get('JOBS_DB', '')
+JOBS_TTL = int(os.environ.get('JOBS_TTL', 3600))
+JOBS_LEASE = int(os.environ.get('JOBS_LEASE', 60))
+if WORKER_PROCESSES > 1 and not JOBS_DB:
+    print(f"Warning: JOBS_DB is not set, so each of the {WORKER_PROCESSES} workers only sees its own /jobs")
 
+# Model versions can be loaded, canaried, shadowed and swapped at runtime via
+# /models. Those endpoints are disabled unless MODEL_ADMIN_TOKEN is set, and
+# then require it as a bearer token. Shadow runs use up to SHADOW_WORKERS
+# threads and are dropped while SHADOW_MAX_PENDING are already waiting.
+MODEL_ADMIN_TOKEN = os.environ.get('MODEL_ADMIN_TOKEN', '')
+SHADOW_WORKERS = int(os.environ.get('SHADOW_WORKERS', 2))
+SHADOW_MAX_PENDING = int(os.environ.get('SHADOW_MAX_PENDING', 32))
+
+# Disease information database. DISEASE_INFO_FILE (JSON or YAML, one entry per
+# class key) is the source; it is indexed into the SQLite database DISEASE_DB,
+# which is rebuilt only when the source file changes, and searched at /diseases.
+DISEASE_INFO_FILE = os.environ.get('DISEASE_INFO_FILE',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'disease_info.json'))
+DISEASE_DB = os.environ.get('DISEASE_DB', os.path.join(TEMP_DIR, 'plant_disease_info.sqlite3'))
+DISEASE_SEARCH_MAX_PER_PAGE = int(os.environ.get('DISEASE_SEARCH_MAX_PER_PAGE', 100))
+
+# Embeddings and similar-case search. POST /embed returns the penultimate-layer
+# embedding of an upload; POST /similar returns the SIMILAR_CASES_K (?k=, at
+# most SIMILAR_CASES_MAX_K) most similar labelled cases from the index in
+# EMBEDDING_INDEX_DIR, built with index_cases.py, scoring SIMILAR_NPROBE of its
+# IVF lists. Search is off while EMBEDDING_INDEX_DIR is unset.
+EMBEDDING_INDEX_DIR = os.environ.get('EMBEDDING_INDEX_DIR', '')
+SIMILAR_CASES_K = int(os.environ.get('SIMILAR_CASES_K', 5))
+SIMILAR_CASES_MAX_K = int(os.environ.get('SIMILAR_CASES_MAX_K', 50))
+SIMILAR_NPROBE = int(os.environ.get('SIMILAR_NPROBE', 8))
 
-# Download and load model
-print(" ** Downloading Model **")
 try:
-    # Generate the direct download link
-    url = f'https://drive.google.com/uc?id={MODEL_ID}'
-    gdown.download(url, MODEL_PATH, quiet=False)
-    print(" ** Model Downloaded **")
-    
-    # Load the model
-    print(" ** Loading Model **")
-    model = load_model(MODEL_PATH)
+    knowledge_base = DiseaseKnowledgeBase.open(DISEASE_INFO_FILE, DISEASE_DB)
+    DISEASE_INFO = knowledge_base.all()
+except Exception as e:
+    print(f"Error loading disease info: {str(e)}")
+    sys.exit(1)
+
+
+decode_pool = DecodePool(DECODE_WORKERS, kind=DECODE_POOL)
+
+TEMPERATURE = load_temperature(CALIBRATION_FILE)
+
+# Metrics exposed in Prometheus text format at /metrics
+metrics = Registry()
+REQUESTS = metrics.counter('crop_requests', 'Prediction requests by endpoint and outcome', ['endpoint', 'outcome'])
+PREDICTED_CLASSES = metrics.counter('crop_predictions', 'Predictions returned per class', ['class'])
+UPLOAD_SIZE = metrics.histogram('crop_upload_size_bytes', 'Size of uploaded images', buckets=SIZE_BUCKETS)
+STAGE_SECONDS = metrics.histogram('crop_stage_seconds', 'Time spent per request stage', ['stage'])
+REQUEST_SECONDS = metrics.histogram('crop_request_seconds', 'Total request latency', ['endpoint'])
+IN_FLIGHT = metrics.gauge('crop_requests_in_flight', 'Prediction requests currently being handled')
+MODEL_LOAD_SECONDS = metrics.gauge('crop_model_load_seconds', 'Time taken to fetch, load and warm up the model')
+VERSION_INFERENCE_SECONDS = metrics.histogram('crop_version_inference_seconds',
+                                              'Inference latency per model version and role', ['version', 'role'])
+VERSION_CLASSES = metrics.counter('crop_version_predictions', 'Top-1 class per model version and role',
+                                  ['version', 'role', 'class'])
+SHADOW_AGREEMENT = metrics.counter('crop_shadow_agreement', 'Shadow runs whose top-1 class matched the active version',
+                                   ['version', 'agree'])
+SHADOW_DROPPED = metrics.counter('crop_shadow_dropped', 'Shadow runs skipped because the shadow pool was busy')
+if BATCH_ENABLED:
+    metrics.gauge('crop_batch_queue_depth', 'Requests waiting for the batching scheduler',
+                  fn=lambda: registry.active.predictor.stats()['queue_depth'])
+    BATCH_SIZE = metrics.histogram('crop_batch_size', 'Images per batched forward pass',
+                                   buckets={2 ** i for i in range(BATCH_MAX_SIZE.bit_length())} | {BATCH_MAX_SIZE})
+if CACHE_ENABLED:
+    metrics.gauge('crop_cache_hit_ratio', 'Prediction cache hit ratio',
+                  fn=lambda: prediction_cache.stats()['hit_ratio'])
+    metrics.gauge('crop_cache_evictions', 'Prediction cache LRU evictions',
+                  fn=lambda: prediction_cache.stats()['evictions'])
+metrics.gauge('crop_job_queue_depth', 'Async jobs waiting to run', fn=lambda: job_manager.queue_depth())
+
+tracer = Tracer(exporter_from_config(TRACING_EXPORTER, TRACING_FILE, service_name=os.environ.get('OTEL_SERVICE_NAME', 'crop-disease-detection')),
+                sample_ratio=TRACING_SAMPLE_RATIO,
+                slow_ms=TRACING_SLOW_MS,
+                expected=(HTTPException,))
+
+# Set once the model is loaded and warmed up; /ready reports it
+model_ready = threading.Event()
+
+model_store = ModelStore(MODEL_CACHE_DIR, offline=MODEL_OFFLINE)
+
+def load_version(version, path=None, expected_sha256=''):
+    """Fetch (or reuse the cached copy of), load and warm up one model version.
+
+    `version` is a Google Drive file id fetched through the model store,
+    unless the local model file `path` is given.
+    """
+    if path is None:
+        path = model_store.ensure(version, expected_sha256=expected_sha256)
+    print(f" ** Model {version} Ready at {path} **")
+
+    print(f" ** Loading Model ({INFERENCE_BACKEND} backend) **")
+    backend = load_backend(INFERENCE_BACKEND, path, num_threads=TF_INTRA_OP_THREADS,
+                           batch_sizes=INFERENCE_BATCH_SIZES)
     print(" ** Model Loaded **")
+
+    print(" ** Warming Up Model **")
+    backend.warmup()
+
+    predictor = backend
+    if BATCH_ENABLED:
+        predictor = BatchScheduler(backend.predict,
+                                   max_batch_size=BATCH_MAX_SIZE,
+                                   max_wait_ms=BATCH_MAX_WAIT_MS,
+                                   max_queue=INFERENCE_QUEUE_SIZE,
+                                   on_batch=BATCH_SIZE.observe)
+    return ModelVersion(version, backend, predictor)
+
+def load_candidate(version, path=None):
+    """Registry loader for versions loaded at runtime, checked against the label index"""
+    loaded = load_version(version, path)
+    try:
+        label_index.verify(loaded.num_classes)
+        if case_index is not None:
+            # /similar compares the hash with the model the case index was
+            # built from; computed now rather than on a request
+            loaded.sha256()
+            size = getattr(loaded.backend, 'embedding_size', None)
+            if size is not None and size != case_index.dim:
+                print(f"Warning: model version {version} embeds into {size}-d vectors but the similar-case "
+                      f"index holds {case_index.dim}-d ones; /similar answers 409 while it is active")
+    except Exception:
+        loaded.close()
+        raise
+    return loaded
+
+def _on_activate(version):
+    # Cached predictions belong to the version that made them
+    if prediction_cache is not None:
+        prediction_cache.set_namespace(version.fingerprint)
+
+registry = ModelRegistry(load_candidate, on_activate=_on_activate)
+
+# Fetch (or reuse the cached copy of) and load model
+print(" ** Fetching Model **")
+model_load_started = time.perf_counter()
+try:
+    # Thread pools can only be sized before TensorFlow runs its first op
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+        tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+    except RuntimeError as e:
+        print(f"TensorFlow already initialized, keeping its thread pools: {str(e)}")
+
+    if INFERENCE_BACKEND not in BACKENDS:
+        raise ValueError(f'Unknown INFERENCE_BACKEND {INFERENCE_BACKEND!r}, expected one of {sorted(BACKENDS)}')
+    if MODEL_FILE:
+        initial_version = load_version(MODEL_FILE, path=MODEL_FILE)
+    else:
+        initial_version = load_version(MODEL_ID, expected_sha256=MODEL_SHA256)
+
+    prediction_cache = None
+    if CACHE_ENABLED:
+        prediction_cache = PredictionCache(initial_version.fingerprint,
+                                           max_entries=CACHE_MAX_ENTRIES,
+                                           ttl=CACHE_TTL,
+                                           shared=shared_tier_from_url(CACHE_SHARED_URL, CACHE_SHARED_MAX_ENTRIES))
+    registry.activate(initial_version)
 except Exception as e:
     print(f"Error downloading/loading model: {str(e)}")
     sys.exit(1)
@@ -907,50 +357,256 @@ def get_disease_info(disease_key):
             "severity_level": "Information not available"
         }
 
-def model_predict(img_path, model):
+# Class index -> display names, disease info and pre-serialized response
+# fragments, checked against the model's output layer before serving
+try:
+    label_index = LabelIndex(CLASS_NAMES, get_disease_info)
+    label_index.verify(registry.active.num_classes)
+except Exception as e:
+    print(f"Error building label index: {str(e)}")
+    sys.exit(1)
+# Similar-case index, keyed to the embedding size of the model serving at startup
+case_index = None
+if EMBEDDING_INDEX_DIR:
+    if hasattr(registry.active.backend, 'embed'):
+        try:
+            case_index = VectorIndex(EMBEDDING_INDEX_DIR, registry.active.backend.embedding_size)
+            # Hashed now rather than on the first /similar request
+            registry.active.sha256()
+            print(f" ** Similar-case index: {case_index.stats()} **")
+        except Exception as e:
+            print(f"Error opening similar-case index: {str(e)}")
+            sys.exit(1)
+    else:
+        print(f"Similar-case search needs the keras backend, not {INFERENCE_BACKEND}; /similar is disabled")
+
+# Classes that are a disease rather than healthy tissue, for tiled diagnoses
+disease_classes = np.array([not key.endswith('healthy') for key in label_index.keys])
+MODEL_LOAD_SECONDS.set(time.perf_counter() - model_load_started)
+model_ready.set()
+print(" ** Model Ready **")
+
+def score_prediction(d, k=None):
+    """Calibrated probabilities, top-k class indices and the uncertain flag for one softmax row"""
+    p = calibrate(np.asarray(d, dtype=np.float64), TEMPERATURE)
+    idx = top_k(p, k or TOP_K)
+    PREDICTED_CLASSES.inc(**{'class': label_index.keys[idx[0]]})
+    return p, idx, bool(p[idx[0]] < UNCERTAIN_THRESHOLD)
+
+def decode_prediction(d, k=None, compact=False):
+    """Turn one row of softmax output into the crop/disease response"""
+    if compact:
+        return label_index.as_compact_dict(*score_prediction(d, k))
+    return label_index.as_dict(*score_prediction(d, k))
+
+# Disease info served as cacheable documents at /diseases/<key>, so compact
+# /predict responses don't have to carry it
+disease_resources = {key: CachedResource(get_disease_info(key)) for key in set(DISEASE_INFO) | set(CLASS_NAMES)}
+
+def rejected_result(reason):
+    return {
+        'crop': 'Error',
+        'disease': f'Image rejected: {reason.replace("_", " ")}',
+        'disease_info': None,
+        'rejected': True,
+        'reason': reason
+    }
+
+def failed_result():
+    return {
+        'crop': 'Error',
+        'disease': 'Failed to process image',
+        'disease_info': None
+    }
+
+def _timed_predict(model, x, timings):
+    """Forward pass for one image, or the mean softmax over its stacked TTA
+    views; with the batching scheduler 'inference' includes the time spent
+    queued, which is also recorded as 'queue'"""
+    with tracer.span('inference', **{'batch.size': len(x)}) as span:
+        start = time.perf_counter()
+        if isinstance(model, BatchScheduler):
+            d = model.predict(x, timings=timings).mean(axis=0)
+        else:
+            d = model.predict(x).mean(axis=0)
+        timings['inference'] = time.perf_counter() - start
+        if span is not None and 'queue' in timings:
+            span.add_stages([('queue', timings['queue']), ('forward', timings['inference'] - timings['queue'])])
+    return d
+
+def parse_tta(value):
+    """Number of TTA views from a ?tta= value, TTA_VIEWS when absent; raises ValueError"""
+    tta = TTA_VIEWS if value in (None, '') else int(value)
+    if not 1 <= tta <= len(TTA_VIEW_NAMES):
+        raise ValueError(f'tta must be between 1 and {len(TTA_VIEW_NAMES)}')
+    return tta
+
+def parse_top_k(value):
+    """Number of classes to list from a ?top_k= value, None (TOP_K) when absent; raises ValueError"""
+    if value in (None, ''):
+        return None
     try:
-        img = image.load_img(img_path, target_size=(224, 224))
-        x = image.img_to_array(img)
-        x = np.expand_dims(x, axis=0)
-        x = x/255.0
-
-        preds = model.predict(x)
-        d = preds.flatten()
-        j = d.max()
-        
-        li = ['Apple___Apple_scab', 'Apple___Black_rot', 'Apple___Cedar_apple_rust', 'Apple___healthy', 
-              'Blueberry___healthy', 'Cherry_(including_sour)___Powdery_mildew', 'Cherry_(including_sour)___healthy',
-              'Corn_(maize)___Cercospora_leaf_spot Gray_leaf_spot', 'Corn_(maize)___Common_rust_',
-              'Corn_(maize)___Northern_Leaf_Blight', 'Corn_(maize)___healthy', 'Grape___Black_rot',
-              'Grape___Esca_(Black_Measles)', 'Grape___Leaf_blight_(Isariopsis_Leaf_Spot)', 'Grape___healthy',
-              'Orange___Haunglongbing_(Citrus_greening)', 'Peach___Bacterial_spot', 'Peach___healthy',
-              'Pepper,_bell___Bacterial_spot', 'Pepper,_bell___healthy', 'Potato___Early_blight',
-              'Potato___Late_blight', 'Potato___healthy', 'Raspberry___healthy', 'Soybean___healthy',
-              'Squash___Powdery_mildew', 'Strawberry___Leaf_scorch', 'Strawberry___healthy',
-              'Tomato___Bacterial_spot', 'Tomato___Early_blight', 'Tomato___Late_blight', 'Tomato___Leaf_Mold',
-              'Tomato___Septoria_leaf_spot', 'Tomato___Spider_mites Two-spotted_spider_mite',
-              'Tomato___Target_Spot', 'Tomato___Tomato_Yellow_Leaf_Curl_Virus', 'Tomato___Tomato_mosaic_virus',
-              'Tomato___healthy']
-        
-        class_idx = np.argmax(d)
-        disease_key = li[class_idx]
-        class_name = disease_key.split('___')
-        
-        # Get detailed information about the disease
-        disease_info = get_disease_info(disease_key)
-        
-        return {
-            'crop': class_name[0],
-            'disease': class_name[1].replace('_', ' '),
-            'disease_info': disease_info
-        }
+        k = int(value)
+    except ValueError:
+        k = 0
+    if not 1 <= k <= len(CLASS_NAMES):
+        raise ValueError(f'top_k must be between 1 and {len(CLASS_NAMES)}')
+    return k
+
+def tta_suffix(tta):
+    # TTA results are cached apart from plain ones
+    return f':tta{tta}' if tta > 1 else ''
+
+def tta_info(tta):
+    return {'views': tta, 'augmentations': list(TTA_VIEW_NAMES[:tta])}
+
+def _augment(x, tta, timings):
+    """The (tta, 224, 224, 3) batch of augmented views of a decoded image; x itself for tta=1"""
+    if tta == 1:
+        return x
+    with tracer.span('augment', **{'tta.views': tta}):
+        start = time.perf_counter()
+        x = tta_views(x, tta)
+        timings['augment'] = time.perf_counter() - start
+    return x
+
+def cached_predict(data, model, timings=None, namespace=None, tta=1):
+    """Softmax row for raw upload bytes, served from the prediction cache when possible.
+
+    `namespace` is the cache namespace (fingerprint) of the version `model`
+    belongs to; without one the cache is not used. With tta > 1 the row is
+    the average over that many augmented views.
+    """
+    if timings is None:
+        timings = {}
+    cache = prediction_cache if namespace is not None else None
+    suffix = tta_suffix(tta)
+    if cache is not None:
+        with tracer.span('cache_lookup') as span:
+            key = content_key(data) + suffix
+            d = cache.get(key, namespace)
+            if span is not None:
+                span.set_attribute('cache.hit', d is not None)
+        if d is not None:
+            return np.asarray(d)
+
+    # Decoding runs on the pool; its worker-measured stages become child spans
+    with tracer.span('decode_pool', **{'decode_pool.kind': DECODE_POOL}) as span:
+        x = decode_pool.decode(data, timings)
+        if span is not None:
+            span.add_stages([('decode', timings['decode']), ('preprocess', timings['preprocess'])])
+    if QUALITY_CHECK:
+        with tracer.span('quality_check') as span:
+            reason = check_quality(x)
+            if span is not None and reason:
+                span.set_attribute('quality.rejected', reason)
+        if reason:
+            raise ImageRejected(reason)
+    if cache is None:
+        return _timed_predict(model, _augment(x, tta, timings), timings)
+
+    if CACHE_PHASH:
+        pkey = perceptual_key(x) + suffix
+        d = cache.get(pkey, namespace)
+        if d is not None:
+            cache.put(key, d, namespace)
+            return np.asarray(d)
+
+    d = _timed_predict(model, _augment(x, tta, timings), timings)
+    cache.put(key, d.tolist(), namespace)
+    if CACHE_PHASH:
+        cache.put(pkey, d.tolist(), namespace)
+    return d
+
+def observe_version(version, role, d, seconds=None):
+    """Record one prediction in the per-version metrics and return its top-1 class index"""
+    top = int(np.argmax(d))
+    VERSION_CLASSES.inc(version=version.name, role=role, **{'class': label_index.keys[top]})
+    if seconds is not None:
+        VERSION_INFERENCE_SECONDS.observe(seconds, version=version.name, role=role)
+    return top
+
+shadow_pool = ThreadPoolExecutor(max_workers=SHADOW_WORKERS, thread_name_prefix='shadow')
+shadow_slots = threading.BoundedSemaphore(SHADOW_MAX_PENDING)
+
+def _shadow_predict(version, data, primary_top):
+    try:
+        x = preprocess_image(io.BytesIO(data))
+        start = time.perf_counter()
+        d = version.predictor.predict(x).flatten()
+        top = observe_version(version, 'shadow', d, time.perf_counter() - start)
+        SHADOW_AGREEMENT.inc(version=version.name, agree=str(top == primary_top).lower())
+    except Exception as e:
+        print(f"Error in shadow prediction: {str(e)}")
+    finally:
+        shadow_slots.release()
+
+def submit_shadow(version, data, primary_top):
+    """Run an upload through a shadow version in the background; its result is only measured"""
+    if not shadow_slots.acquire(blocking=False):
+        SHADOW_DROPPED.inc()
+        return
+    shadow_pool.submit(_shadow_predict, version, data, primary_top)
+
+def render_prediction(d, k=None, compact=False, tta=1):
+    """One softmax row as response JSON bytes, with the 'tta' block when views were averaged"""
+    if tta == 1:
+        scored = score_prediction(d, k)
+        return label_index.render_compact(*scored) if compact else label_index.render(*scored)
+    result = decode_prediction(d, k, compact)
+    result['tta'] = tta_info(tta)
+    return json.dumps(result).encode()
+
+def model_predict(img_path, version, k=None, render=False, compact=False, timings=None, shadow=None, tta=1):
+    """Predict from an image path, file-like object or raw upload bytes with a ModelVersion.
+
+    With render=True a successful prediction comes back as ready-made JSON
+    bytes; compact=True leaves out the disease info block. Stage durations
+    are recorded into `timings` when given. Only the active version reads
+    and fills the prediction cache; with `shadow`, uploads are also run
+    through that version in the background for comparison. With tta > 1
+    the prediction averages that many augmented views, listed under 'tta'.
+    """
+    if timings is None:
+        timings = {}
+    try:
+        active = version is registry.active
+        if isinstance(img_path, bytes):
+            d = cached_predict(img_path, version.predictor, timings,
+                               namespace=version.fingerprint if active else None, tta=tta)
+        else:
+            d = _timed_predict(version.predictor, _augment(preprocess_image(img_path, timings), tta, timings), timings)
+        top = observe_version(version, 'active' if active else 'canary', d, timings.get('inference'))
+        if shadow is not None and isinstance(img_path, bytes):
+            submit_shadow(shadow, img_path, top)
+        with tracer.span('serialize'):
+            start = time.perf_counter()
+            if render:
+                result = render_prediction(d, k, compact, tta)
+            else:
+                result = decode_prediction(d, k, compact)
+                if tta > 1:
+                    result['tta'] = tta_info(tta)
+            timings['serialize'] = time.perf_counter() - start
+        return result
+    except ImageRejected as e:
+        return rejected_result(e.reason)
     except Exception as e:
+        record_exception(e)
         print(f"Error in prediction: {str(e)}")
-        return {
-            'crop': 'Error',
-            'disease': 'Failed to process image',
-            'disease_info': None
-        }
+        return failed_result()
+
+def _archive_upload(data, filename):
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        # Prefix with a uuid so concurrent uploads with the same name don't clobber each other
+        file_path = os.path.join(ARCHIVE_DIR, f'{uuid.uuid4().hex}_{secure_filename(filename)}')
+        with open(file_path, 'wb') as out:
+            out.write(data)
+    except Exception as e:
+        print(f"Error archiving upload: {str(e)}")
+
+archive_pool = ThreadPoolExecutor(max_workers=1) if ARCHIVE_UPLOADS else None
 
 @app.route('/')
 def index():
@@ -959,24 +615,590 @@ def index():
 @app.route('/predict', methods=['GET', 'POST'])
 def upload():
     if request.method == 'POST':
+        with tracer.start_trace('POST /predict', request.headers.get('traceparent')) as root:
+            response = app.make_response(_upload(root))
+            response.headers['X-Trace-Id'] = root.trace_id
+            return response
+    return None
+
+def _upload(root):
+    started = time.perf_counter()
+    timings = {}
+    outcome = 'error'
+    IN_FLIGHT.inc()
+    try:
+        with tracer.span('upload_read'):
+            f = request.files['file']
+            data = read_image(f, MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)
+            timings['read'] = time.perf_counter() - started
+        root.set_attribute('upload.size', len(data))
+        UPLOAD_SIZE.observe(len(data))
+        if archive_pool is not None:
+            archive_pool.submit(_archive_upload, data, f.filename)
+
         try:
+            tta = parse_tta(request.args.get('tta'))
+            k = parse_top_k(request.args.get('top_k'))
+        except ValueError as e:
+            outcome = 'bad_request'
+            return jsonify({'error': str(e)}), 400
+        root.set_attribute('tta.views', tta)
+
+        # Get prediction and disease information
+        version, shadow = registry.route()
+        root.set_attribute('model.version', version.name)
+        result = model_predict(data, version, k, render=True,
+                               compact=request.args.get('mode') == 'compact', timings=timings, shadow=shadow,
+                               tta=tta)
+        if isinstance(result, bytes):
+            outcome = 'ok'
+            response = app.response_class(result, mimetype='application/json')
+        else:
+            outcome = 'rejected' if result.get('rejected') else 'error'
+            response = jsonify(result)
+        if TIMING_HEADER:
+            response.headers['Server-Timing'] = ', '.join(
+                f'{stage};dur={seconds * 1000.0:.2f}' for stage, seconds in timings.items())
+        return response
+    except HTTPException as e:
+        # Rejected uploads (413, 415) and malformed requests (400, e.g. no 'file' part)
+        outcome = {413: 'too_large', 415: 'unsupported'}.get(e.code, 'bad_request')
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        record_exception(e)
+        return jsonify({
+            'error': str(e)
+        })
+    finally:
+        IN_FLIGHT.dec()
+        root.set_attribute('outcome', outcome)
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        REQUESTS.inc(endpoint='predict', outcome=outcome)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='predict')
+
+class _UploadBudget:
+    """Files and image bytes a batch request may still take in. Exceeding
+    either fails the whole request with 413, before anything more is read."""
+
+    def __init__(self, max_files=BATCH_UPLOAD_MAX_FILES, max_bytes=BATCH_UPLOAD_MAX_BYTES):
+        self.max_files = self.files = max_files
+        self.max_bytes = self.bytes = max_bytes
+
+    def count(self):
+        if self.files <= 0:
+            raise RequestEntityTooLarge(f'Too many images, at most {self.max_files} per request')
+        self.files -= 1
+
+    def spend(self, size):
+        if size > self.bytes:
+            raise RequestEntityTooLarge(f'Uploads exceed the limit of {self.max_bytes} bytes per request')
+        self.bytes -= size
+
+def _archive_item(name, size, read, budget, charge=True):
+    """An item for one archive member, checked like a directly uploaded image.
+    The declared size is checked (and, unless the caller already did,
+    charged to the request's budget) first so oversized members are never
+    extracted."""
+    budget.count()
+    if size > MAX_IMAGE_BYTES:
+        return {'filename': name, 'error': f'Image exceeds the limit of {MAX_IMAGE_BYTES} bytes'}
+    if charge:
+        budget.spend(size)
+    try:
+        data = read()
+        check_image(data, MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)
+        return {'filename': name, 'data': data}
+    except HTTPException as e:
+        return {'filename': name, 'error': e.description}
+
+def _read_archive(f, budget):
+    """Yield an item for every image member of an uploaded zip/tar archive"""
+    if f.stream.error is not None:
+        raise ValueError(f.stream.error.description)
+    data = f.read()
+    if zipfile.is_zipfile(io.BytesIO(data)):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield _archive_item(info.filename, info.file_size, lambda info=info: zf.read(info), budget)
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            for member in tf:
+                # A compressed tar can only be walked by decompressing every
+                # member, wanted or not, so all of them are charged up front
+                budget.spend(tarfile.BLOCKSIZE + member.size)
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield _archive_item(member.name, member.size, lambda member=member: tf.extractfile(member).read(),
+                                        budget, charge=False)
+
+def predict_items(items, k=None, compact=False):
+    """Predict a list of {'filename', 'data'} items in one batch, in place.
+
+    Items that already carry an 'error' are passed through untouched; every
+    other item gets the prediction fields or its own 'error'.
+    """
+    # Answer repeats from the cache, decode the rest in parallel and run every
+    # decodable image as one stacked batch
+    version = registry.active
+    if prediction_cache is not None:
+        for item in items:
+            if 'data' in item:
+                item['key'] = content_key(item['data'])
+                d = prediction_cache.get(item['key'], version.fingerprint)
+                if d is not None:
+                    del item['data']
+                    item.update(decode_prediction(d, k, compact))
+
+    pending = [item for item in items if 'data' in item]
+    with STAGE_SECONDS.time(stage='batch_decode'), tracer.span('batch_decode', **{'batch.size': len(pending)}):
+        batch, errors = decode_pool.decode_batch([item.pop('data') for item in pending])
+    rows = []
+    for i, (item, error) in enumerate(zip(pending, errors)):
+        if error is None and QUALITY_CHECK:
+            reason = check_quality(batch[i:i + 1])
+            if reason:
+                item.update(rejected_result(reason))
+                continue
+        if error is not None:
+            item['error'] = error
+        else:
+            rows.append(i)
+
+    decoded = [pending[i] for i in rows]
+    if decoded:
+        try:
+            with STAGE_SECONDS.time(stage='batch_inference'), tracer.span('batch_inference', **{'batch.size': len(rows)}):
+                preds = version.predictor.predict(batch if len(rows) == len(pending) else batch[rows])
+            for item, d in zip(decoded, preds):
+                observe_version(version, 'active', d)
+                if prediction_cache is not None:
+                    prediction_cache.put(item['key'], d.tolist(), version.fingerprint)
+                item.update(decode_prediction(d, k, compact))
+        except Exception as e:
+            record_exception(e)
+            print(f"Error in batch prediction: {str(e)}")
+            for item in decoded:
+                item['error'] = 'Failed to process image'
+
+    for item in items:
+        item.pop('key', None)
+    return items
+
+def _read_uploaded_images():
+    """Collect the 'files' and 'archive' parts of a multipart request as items.
+    Raises RequestEntityTooLarge as soon as the request's file or byte budget runs out."""
+    items = []
+    budget = _UploadBudget()
+    for f in request.files.getlist('files'):
+        budget.count()
+        try:
+            items.append({'filename': f.filename, 'data': read_image(f, MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)})
+        except HTTPException as e:
+            items.append({'filename': f.filename, 'error': e.description})
+            continue
+        budget.spend(len(items[-1]['data']))
+        if archive_pool is not None:
+            archive_pool.submit(_archive_upload, items[-1]['data'], f.filename)
+    for f in request.files.getlist('archive'):
+        try:
+            items.extend(_read_archive(f, budget))
+        except RequestEntityTooLarge:
+            raise
+        except Exception as e:
+            budget.count()
+            items.append({'filename': f.filename, 'error': f'Failed to read archive: {str(e)}'})
+    return items
+
+@app.route('/predict/batch', methods=['POST'])
+def upload_batch():
+    with tracer.start_trace('POST /predict/batch', request.headers.get('traceparent')) as root:
+        response = app.make_response(_upload_batch(root))
+        response.headers['X-Trace-Id'] = root.trace_id
+        return response
+
+def _upload_batch(root):
+    started = time.perf_counter()
+    IN_FLIGHT.inc()
+    try:
+        try:
+            k = parse_top_k(request.args.get('top_k'))
+        except ValueError as e:
+            REQUESTS.inc(endpoint='predict_batch', outcome='bad_request')
+            return jsonify({'error': str(e)}), 400
+        with tracer.span('upload_read'):
+            try:
+                items = _read_uploaded_images()
+            except RequestEntityTooLarge as e:
+                REQUESTS.inc(endpoint='predict_batch', outcome='too_large')
+                return jsonify({'error': e.description}), 413
+        root.set_attribute('batch.files', len(items))
+        for item in items:
+            if 'data' in item:
+                UPLOAD_SIZE.observe(len(item['data']))
+        if not items:
+            REQUESTS.inc(endpoint='predict_batch', outcome='bad_request')
+            return jsonify({'error': 'No images uploaded'}), 400
+        results = predict_items(items, k, request.args.get('mode') == 'compact')
+        for item in results:
+            outcome = 'rejected' if item.get('rejected') else 'error' if 'error' in item else 'ok'
+            REQUESTS.inc(endpoint='predict_batch', outcome=outcome)
+        return jsonify({'results': results})
+    finally:
+        IN_FLIGHT.dec()
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='predict_batch')
+
+def tiled_predict(data, overlap=None, k=None, compact=False, timings=None):
+    """Diagnose a large image from its overlapping tiles, run as one batch.
+
+    Returns the response dict: the overall diagnosis (shaped like a /predict
+    result, plus the share of leaf tiles it covers), per-class coverage and
+    a rows x cols heatmap of each tile's top class and confidence.
+    """
+    if timings is None:
+        timings = {}
+    with tracer.span('decode') as span:
+        start = time.perf_counter()
+        image, grid = decode_tiled(io.BytesIO(data), TILE_OVERLAP if overlap is None else overlap, TILE_MAX_TILES)
+        timings['decode'] = time.perf_counter() - start
+        if span is not None:
+            span.set_attribute('tiles.grid', f'{grid.rows}x{grid.cols}')
+    with tracer.span('tile_select') as span:
+        start = time.perf_counter()
+        tiles = tile_views(image, grid)
+        batch, rows, cols = select_tiles(tiles, TILE_MIN_LEAF_FRACTION)
+        timings['tile_select'] = time.perf_counter() - start
+        if span is not None:
+            span.set_attribute('tiles.analyzed', len(batch))
+    if not len(batch):
+        raise ImageRejected('no_leaf_detected')
+
+    version = registry.active
+    with tracer.span('inference', **{'batch.size': len(batch)}):
+        start = time.perf_counter()
+        probs = calibrate(np.asarray(version.predictor.predict(batch), dtype=np.float64), TEMPERATURE)
+        timings['inference'] = time.perf_counter() - start
+    VERSION_INFERENCE_SECONDS.observe(timings['inference'], version=version.name, role='tiled')
+
+    summary = summarize(probs, rows, cols, grid, disease_classes, TILE_DISEASE_COVERAGE)
+    chosen = summary['diagnosis']
+    idx = [chosen] + [int(i) for i in top_k(summary['mean'], (k or TOP_K) + 1) if i != chosen][:(k or TOP_K) - 1]
+    uncertain = summary['confidence'] < UNCERTAIN_THRESHOLD
+    PREDICTED_CLASSES.inc(**{'class': label_index.keys[chosen]})
+    if compact:
+        diagnosis = label_index.as_compact_dict(summary['mean'], idx, uncertain)
+    else:
+        diagnosis = label_index.as_dict(summary['mean'], idx, uncertain)
+    # Confidence within the tiles it was found on, not diluted by the healthy rest
+    diagnosis.update(confidence=summary['confidence'], coverage=summary['coverage'])
+
+    coverage = summary['coverage_by_class']
+    return {
+        'diagnosis': diagnosis,
+        'coverage': [dict(label_index.top_k_entry(i, summary['mean'][i]), fraction=float(coverage[i]))
+                     for i in np.argsort(coverage)[::-1] if coverage[i] > 0],
+        'tiles': dict(grid.describe(), analyzed=len(batch), skipped_background=grid.rows * grid.cols - len(batch)),
+        'heatmap': {
+            'class_index': summary['heatmap_class'].tolist(),
+            'confidence': np.round(summary['heatmap_confidence'], 4).tolist(),
+        },
+    }
+
+@app.route('/predict/tiled', methods=['POST'])
+def upload_tiled():
+    """Tiled prediction for one large image: ?overlap= (0-0.9), top_k, mode=compact"""
+    with tracer.start_trace('POST /predict/tiled', request.headers.get('traceparent')) as root:
+        response = app.make_response(_upload_tiled(root))
+        response.headers['X-Trace-Id'] = root.trace_id
+        return response
+
+def _upload_tiled(root):
+    started = time.perf_counter()
+    timings = {}
+    outcome = 'error'
+    IN_FLIGHT.inc()
+    try:
+        with tracer.span('upload_read'):
             f = request.files['file']
-            basepath = os.path.dirname(__file__)
-            upload_dir = os.path.join(basepath, 'uploads')
-            os.makedirs(upload_dir, exist_ok=True)
-            
-            file_path = os.path.join(upload_dir, secure_filename(f.filename))
-            f.save(file_path)
-
-            # Get prediction and disease information
-            result = model_predict(file_path, model)
-            
-            return jsonify(result)
+            data = read_image(f, MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)
+            timings['read'] = time.perf_counter() - started
+        root.set_attribute('upload.size', len(data))
+        UPLOAD_SIZE.observe(len(data))
+        overlap = request.args.get('overlap', type=float)
+        if overlap is not None and not 0 <= overlap <= 0.9:
+            outcome = 'bad_request'
+            return jsonify({'error': 'overlap must be between 0 and 0.9'}), 400
+        try:
+            k = parse_top_k(request.args.get('top_k'))
+        except ValueError as e:
+            outcome = 'bad_request'
+            return jsonify({'error': str(e)}), 400
+        result = tiled_predict(data, overlap, k,
+                               request.args.get('mode') == 'compact', timings)
+        outcome = 'ok'
+        return jsonify(result)
+    except ImageRejected as e:
+        outcome = 'rejected'
+        return jsonify(rejected_result(e.reason))
+    except HTTPException as e:
+        # Rejected uploads (413, 415) and malformed requests (400, e.g. no 'file' part)
+        outcome = {413: 'too_large', 415: 'unsupported'}.get(e.code, 'bad_request')
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        record_exception(e)
+        print(f"Error in tiled prediction: {str(e)}")
+        return jsonify(failed_result())
+    finally:
+        IN_FLIGHT.dec()
+        root.set_attribute('outcome', outcome)
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        REQUESTS.inc(endpoint='predict_tiled', outcome=outcome)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='predict_tiled')
+
+def embed_upload(data, version):
+    """Penultimate-layer embedding of raw upload bytes with a ModelVersion"""
+    with tracer.span('decode_pool', **{'decode_pool.kind': DECODE_POOL}):
+        x = decode_pool.decode(data)
+    with STAGE_SECONDS.time(stage='embed'), tracer.span('embed'):
+        return version.backend.embed(x)[0]
+
+def _read_embedding(endpoint):
+    """(embedding, version) for the uploaded 'file', or an error response"""
+    version = registry.active
+    if not hasattr(version.backend, 'embed'):
+        REQUESTS.inc(endpoint=endpoint, outcome='unsupported')
+        return None, (jsonify({'error': f'Embeddings are not available with the {INFERENCE_BACKEND} backend'}), 501)
+    data = read_image(request.files['file'], MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS)
+    UPLOAD_SIZE.observe(len(data))
+    try:
+        return (embed_upload(data, version), version), None
+    except Exception as e:
+        record_exception(e)
+        print(f"Error embedding image: {str(e)}")
+        REQUESTS.inc(endpoint=endpoint, outcome='error')
+        return None, (jsonify({'error': 'Failed to process image'}), 400)
+
+@app.route('/embed', methods=['POST'])
+def embed():
+    with tracer.start_trace('POST /embed', request.headers.get('traceparent')):
+        found, error = _read_embedding('embed')
+        if error:
+            return error
+        embedding, version = found
+        REQUESTS.inc(endpoint='embed', outcome='ok')
+        return jsonify({'embedding': embedding.tolist(), 'size': len(embedding), 'model_version': version.name})
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    """The ?k= labelled past cases that look most like the uploaded 'file'"""
+    if case_index is None:
+        return jsonify({'error': 'Similar-case search is disabled, set EMBEDDING_INDEX_DIR to enable it'}), 404
+    k = request.args.get('k', SIMILAR_CASES_K, type=int)
+    if not 1 <= k <= SIMILAR_CASES_MAX_K:
+        return jsonify({'error': f'k must be between 1 and {SIMILAR_CASES_MAX_K}'}), 400
+    with tracer.start_trace('POST /similar', request.headers.get('traceparent')):
+        found, error = _read_embedding('similar')
+        if error:
+            return error
+        embedding, version = found
+        if len(embedding) != case_index.dim:
+            REQUESTS.inc(endpoint='similar', outcome='conflict')
+            return jsonify({'error': f'Model version {version.name} embeds into {len(embedding)}-d vectors but the '
+                                     f'similar-case index holds {case_index.dim}-d ones; rebuild it with index_cases.py'}), 409
+        try:
+            with STAGE_SECONDS.time(stage='similar_search'), tracer.span('similar_search', k=k):
+                ids, scores = case_index.search(embedding, k, SIMILAR_NPROBE)
+                cases = case_index.cases(ids)
         except Exception as e:
-            return jsonify({
-                'error': str(e)
-            })
+            record_exception(e)
+            print(f"Error searching similar cases: {str(e)}")
+            REQUESTS.inc(endpoint='similar', outcome='error')
+            return jsonify({'error': 'Similar-case search failed'}), 503
+        results = []
+        for i, score in zip(ids, scores):
+            case = cases.get(int(i))
+            if case is None:
+                continue
+            crop, _, disease = case['label'].partition('___')
+            results.append({'id': int(i), 'label': case['label'], 'crop': crop, 'disease': disease.replace('_', ' '),
+                            'similarity': float(score), 'source': case['source'], 'added': case['added']})
+        REQUESTS.inc(endpoint='similar', outcome='ok')
+        return jsonify({
+            'cases': results,
+            'model_version': version.name,
+            # Embeddings from another model are not comparable; the index needs rebuilding
+            'index_stale': case_index.get_meta('model_sha256') not in (None, version.sha256()),
+        })
+
+@app.route('/similar/stats', methods=['GET'])
+def similar_stats():
+    if case_index is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(case_index.stats(), enabled=True))
+
+job_manager = JobManager(SQLiteJobStore(JOBS_DB, lease=JOBS_LEASE) if JOBS_DB else MemoryJobStore(),
+                         predict_items,
+                         workers=JOBS_WORKERS,
+                         max_queue=JOBS_MAX_QUEUE,
+                         ttl=JOBS_TTL)
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    try:
+        items = _read_uploaded_images()
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
+    if not items:
+        return jsonify({'error': 'No images uploaded'}), 400
+    try:
+        job_id = job_manager.submit(items)
+    except QueueFull:
+        return jsonify({'error': 'Job queue is full, retry later'}), 429, {'Retry-After': '5'}
+    return jsonify({'job_id': job_id, 'status': 'queued', 'url': url_for('get_job', job_id=job_id)}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(e):
+    return jsonify({'error': e.description}), e.code
+
+def _temperature_range(value):
+    """'65' or '60-70' in °F -> (low, high)"""
+    low, _, high = value.partition('-')
+    return float(low), float(high or low)
+
+@app.route('/diseases', methods=['GET'])
+def search_diseases():
+    """Search the disease catalogue: ?q= (full text), crop, pesticide, severity,
+    min_severity, humidity, temperature (°F, '65' or '60-70'), include_healthy,
+    expand (include the full disease info), page and per_page"""
+    args = request.args
+    try:
+        page = args.get('page', 1, type=int)
+        per_page = min(args.get('per_page', 20, type=int), DISEASE_SEARCH_MAX_PER_PAGE)
+        if page < 1 or per_page < 1:
+            raise ValueError('page and per_page must be positive')
+        total, results = knowledge_base.search(
+            q=args.get('q'),
+            crop=args.get('crop'),
+            pesticide=args.get('pesticide'),
+            severity=args.get('severity'),
+            min_severity=args.get('min_severity'),
+            humidity=args.get('humidity'),
+            temperature=_temperature_range(args['temperature']) if args.get('temperature') else None,
+            include_healthy=args.get('include_healthy') == '1',
+            page=page,
+            per_page=per_page,
+            expand=args.get('expand') == '1')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    for result in results:
+        result['url'] = url_for('disease', disease_key=result['key'])
+    response = {'results': results, 'total': total, 'page': page, 'per_page': per_page}
+    if page * per_page < total:
+        response['next'] = url_for('search_diseases', **dict(args.items(), page=page + 1))
+    return jsonify(response)
+
+@app.route('/diseases/pesticides', methods=['GET'])
+def disease_pesticides():
+    return jsonify({'pesticides': knowledge_base.pesticides()})
+
+@app.route('/diseases/<path:disease_key>', methods=['GET'])
+def disease(disease_key):
+    resource = disease_resources.get(disease_key)
+    if resource is None:
+        return jsonify({'error': 'Unknown disease'}), 404
+    return resource.response(app.response_class)
+
+def _admin_denied():
+    if not MODEL_ADMIN_TOKEN:
+        return jsonify({'error': 'Model administration is disabled, set MODEL_ADMIN_TOKEN to enable it'}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {MODEL_ADMIN_TOKEN}'):
+        return jsonify({'error': 'Missing or wrong admin token'}), 401
     return None
 
+@app.route('/models', methods=['GET'])
+def models():
+    return _admin_denied() or jsonify(registry.status())
+
+@app.route('/models', methods=['POST'])
+def load_model_version():
+    """Start loading a version: {"version": <drive id>} or {"path": <local model file>},
+    plus "mode": "activate"|"canary"|"shadow" and "percent": 10"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    body = request.get_json(silent=True) or {}
+    if bool(body.get('version')) == bool(body.get('path')):
+        return jsonify({'error': 'Expected a JSON body with either a version (Google Drive file id) or a path'}), 400
+    try:
+        path = None
+        if body.get('path'):
+            path = name = str(body['path'])
+            if not os.path.isfile(path):
+                raise ValueError(f'No model file at {path}')
+        else:
+            name = check_version(body['version'])
+        percent = float(body.get('percent', 0))
+        if not 0 <= percent <= 100:
+            raise ValueError('percent must be between 0 and 100')
+        registry.load(name, body.get('mode', 'activate'), percent, path=path)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'version': name, 'status': 'loading', 'url': url_for('models')}), 202
+
+@app.route('/models/promote', methods=['POST'])
+def promote_model_version():
+    denied = _admin_denied()
+    if denied:
+        return denied
+    try:
+        version = registry.promote()
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'active': version.describe()})
+
+@app.route('/models/candidate', methods=['DELETE'])
+def drop_model_candidate():
+    denied = _admin_denied()
+    if denied:
+        return denied
+    try:
+        version = registry.drop_candidate()
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'dropped': version.describe()})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    if not model_ready.is_set():
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'backend': INFERENCE_BACKEND})
+
+@app.route('/batching/stats', methods=['GET'])
+def batching_stats():
+    if not BATCH_ENABLED:
+        return jsonify({'enabled': False})
+    return jsonify(dict(registry.active.predictor.stats(), enabled=True))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    if prediction_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(prediction_cache.stats(), enabled=True))
+
 if __name__ == '__main__':
     app.run(debug=True)
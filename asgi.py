@@ -0,0 +1,294 @@
+"""ASGI entry point serving / and /predict from an event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+Connections, including slow mobile uploads, are held on the event loop at
+the cost of a coroutine each instead of a worker thread. Request bodies are
+parsed incrementally as chunks arrive and validated with the same upload
+guards as the Flask app. CPU-bound work is handed off: decoding to the
+decode pool and inference to the batching scheduler (or a thread pool when
+batching is off). Each of those stages sits behind its own concurrency
+limit, so a burst of uploads waits on the loop rather than piling threads
+onto the CPU.
+
+The model, caches, metrics and tracing are the ones app.py sets up, so
+both entry points behave the same and report to the same /metrics.
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import NEED_DATA, Data, File, MultipartDecoder
+
+import app as service
+from cache import content_key, perceptual_key
+from quality import ImageRejected, check_quality
+from tracing import record_exception
+from uploads import UploadGuard, read_image
+
+# Concurrency limits per stage. Requests over a limit wait on the event loop.
+# Inference submissions are capped below INFERENCE_QUEUE_SIZE so handing a
+# tensor to the batching scheduler never blocks the loop.
+ASYNC_DECODE_CONCURRENCY = int(os.environ.get('ASYNC_DECODE_CONCURRENCY', service.DECODE_WORKERS * 2))
+ASYNC_INFERENCE_CONCURRENCY = int(os.environ.get('ASYNC_INFERENCE_CONCURRENCY',
+                                                 min(64, service.INFERENCE_QUEUE_SIZE or 64)))
+
+tracer = service.tracer
+
+# Only used when batching is disabled; the scheduler has its own worker thread
+inference_pool = None if service.BATCH_ENABLED else ThreadPoolExecutor(
+    max_workers=ASYNC_INFERENCE_CONCURRENCY, thread_name_prefix='async-inference')
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html'), 'rb') as f:
+    INDEX_HTML = f.read()
+
+
+class _Disconnected(Exception):
+    pass
+
+
+class _Limits:
+    """Per-stage semaphores, created on first use so they bind to the server's loop"""
+
+    def __init__(self):
+        self.decode = asyncio.Semaphore(ASYNC_DECODE_CONCURRENCY)
+        self.inference = asyncio.Semaphore(ASYNC_INFERENCE_CONCURRENCY)
+
+
+_limits = None
+
+
+def limits():
+    global _limits
+    if _limits is None:
+        _limits = _Limits()
+    return _limits
+
+
+async def _cache_call(fn, *args):
+    # The in-process LRU is a dict lookup; only a shared tier (redis, files)
+    # does I/O worth moving off the loop
+    if service.prediction_cache.shared is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def read_upload(receive, headers):
+    """Parse the multipart body as it arrives and return its validated 'file' part.
+
+    The rest of the body is not read once that part is complete, and a
+    part that fails validation stops reading straight away.
+    """
+    length = headers.get(b'content-length')
+    if length is not None and int(length) > service.MAX_CONTENT_LENGTH:
+        raise RequestEntityTooLarge()
+    mimetype, options = parse_options_header(headers.get(b'content-type', b'').decode('latin-1'))
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        raise BadRequest('Expected a multipart/form-data upload with a file field')
+
+    decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+    guard, filename, received, more_body = None, None, 0, True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise _Disconnected()
+        chunk = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        received += len(chunk)
+        if received > service.MAX_CONTENT_LENGTH:
+            raise RequestEntityTooLarge()
+        try:
+            decoder.receive_data(chunk)
+            if not more_body:
+                decoder.receive_data(None)
+            event = decoder.next_event()
+            while event is not NEED_DATA:
+                if isinstance(event, File) and event.name == 'file':
+                    guard = UploadGuard(service.MAX_IMAGE_BYTES, service.MAX_IMAGE_PIXELS)
+                    filename = event.filename
+                elif isinstance(event, Data) and guard is not None:
+                    guard.write(event.data)
+                    if not event.more_data:
+                        guard.seek(0)
+                        return FileStorage(guard, filename=filename, name='file')
+                event = decoder.next_event()
+        except ValueError as e:
+            raise BadRequest(f'Malformed multipart body: {str(e)}')
+    raise BadRequest("No 'file' part in the upload")
+
+
+async def predict(data, version, timings, tta=1):
+    """app.cached_predict with decode and inference awaited instead of blocking a thread"""
+    loop = asyncio.get_running_loop()
+    cache = service.prediction_cache if version is service.registry.active else None
+    # Results are cached under the version that computes them, even if
+    # another one is activated before inference finishes
+    namespace = version.fingerprint
+    suffix = service.tta_suffix(tta)
+    if cache is not None:
+        with tracer.span('cache_lookup') as span:
+            key = content_key(data) + suffix
+            d = await _cache_call(cache.get, key, namespace)
+            if span is not None:
+                span.set_attribute('cache.hit', d is not None)
+        if d is not None:
+            return d
+
+    async with limits().decode:
+        with tracer.span('decode_pool', **{'decode_pool.kind': service.DECODE_POOL}) as span:
+            x, stage_timings = await asyncio.wrap_future(service.decode_pool.submit(data))
+            timings.update(stage_timings)
+            if span is not None:
+                span.add_stages([('decode', timings['decode']), ('preprocess', timings['preprocess'])])
+    if service.QUALITY_CHECK:
+        with tracer.span('quality_check') as span:
+            reason = check_quality(x)
+            if span is not None and reason:
+                span.set_attribute('quality.rejected', reason)
+        if reason:
+            raise ImageRejected(reason)
+    if cache is not None and service.CACHE_PHASH:
+        pkey = perceptual_key(x) + suffix
+        d = await _cache_call(cache.get, pkey, namespace)
+        if d is not None:
+            await _cache_call(cache.put, key, d, namespace)
+            return d
+
+    x = service._augment(x, tta, timings)
+    async with limits().inference:
+        with tracer.span('inference', **{'batch.size': len(x)}) as span:
+            start = time.perf_counter()
+            if inference_pool is None:
+                req = version.predictor.submit(x)
+                d = (await asyncio.wrap_future(req.future)).mean(axis=0)
+                timings['queue'] = req.started_at - req.enqueued_at
+            else:
+                d = (await loop.run_in_executor(inference_pool, version.predictor.predict, x)).mean(axis=0)
+            timings['inference'] = time.perf_counter() - start
+            if span is not None and 'queue' in timings:
+                span.add_stages([('queue', timings['queue']), ('forward', timings['inference'] - timings['queue'])])
+    if cache is not None:
+        await _cache_call(cache.put, key, d.tolist(), namespace)
+        if service.CACHE_PHASH:
+            await _cache_call(cache.put, pkey, d.tolist(), namespace)
+    return d
+
+
+async def handle_predict(scope, receive, root):
+    """POST /predict; returns (status, body, headers)"""
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    compact = query.get('mode', [''])[0] == 'compact'
+    headers = dict(scope['headers'])
+    try:
+        k = service.parse_top_k(query.get('top_k', [None])[0])
+        tta = service.parse_tta(query.get('tta', [None])[0])
+    except ValueError as e:
+        service.REQUESTS.inc(endpoint='predict', outcome='bad_request')
+        return 400, json.dumps({'error': str(e)}).encode(), []
+
+    started = time.perf_counter()
+    timings = {}
+    outcome = 'error'
+    service.IN_FLIGHT.inc()
+    try:
+        with tracer.span('upload_read'):
+            upload = await read_upload(receive, headers)
+            data = read_image(upload, service.MAX_IMAGE_BYTES, service.MAX_IMAGE_PIXELS)
+            timings['read'] = time.perf_counter() - started
+        root.set_attribute('upload.size', len(data))
+        service.UPLOAD_SIZE.observe(len(data))
+        if service.archive_pool is not None:
+            service.archive_pool.submit(service._archive_upload, data, upload.filename)
+
+        try:
+            version, shadow = service.registry.route()
+            root.set_attribute('model.version', version.name)
+            root.set_attribute('tta.views', tta)
+            d = await predict(data, version, timings, tta)
+            top = service.observe_version(version, 'active' if version is service.registry.active else 'canary',
+                                          d, timings.get('inference'))
+            if shadow is not None:
+                service.submit_shadow(shadow, data, top)
+            with tracer.span('serialize'):
+                start = time.perf_counter()
+                body = service.render_prediction(d, k, compact, tta)
+                timings['serialize'] = time.perf_counter() - start
+            outcome = 'ok'
+        except ImageRejected as e:
+            outcome = 'rejected'
+            body = json.dumps(service.rejected_result(e.reason)).encode()
+        except Exception as e:
+            record_exception(e)
+            print(f"Error in prediction: {str(e)}")
+            body = json.dumps(service.failed_result()).encode()
+        extra = []
+        if service.TIMING_HEADER:
+            extra.append((b'server-timing', ', '.join(
+                f'{stage};dur={seconds * 1000.0:.2f}' for stage, seconds in timings.items()).encode()))
+        return 200, body, extra
+    except HTTPException as e:
+        outcome = {413: 'too_large', 415: 'unsupported'}.get(e.code, 'bad_request')
+        return e.code, json.dumps({'error': e.description}).encode(), []
+    finally:
+        service.IN_FLIGHT.dec()
+        root.set_attribute('outcome', outcome)
+        for stage, seconds in timings.items():
+            service.STAGE_SECONDS.observe(seconds, stage=stage)
+        service.REQUESTS.inc(endpoint='predict', outcome=outcome)
+        service.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint='predict')
+
+
+async def _send(send, status, body, content_type=b'application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            limits()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    path, method = scope['path'], scope['method']
+    if path == '/' and method in ('GET', 'HEAD'):
+        return await _send(send, 200, INDEX_HTML, b'text/html; charset=utf-8')
+    if path == '/predict' and method == 'POST':
+        traceparent = dict(scope['headers']).get(b'traceparent')
+        with tracer.start_trace('POST /predict', traceparent and traceparent.decode('latin-1')) as root:
+            try:
+                status, body, headers = await handle_predict(scope, receive, root)
+            except _Disconnected:
+                root.set_attribute('outcome', 'disconnected')
+                return
+            headers.append((b'x-trace-id', root.trace_id.encode()))
+            return await _send(send, status, body, headers=headers)
+    if path == '/ready' and method == 'GET':
+        if not service.model_ready.is_set():
+            return await _send(send, 503, json.dumps({'ready': False}).encode())
+        return await _send(send, 200, json.dumps({'ready': True, 'backend': service.INFERENCE_BACKEND}).encode())
+    if path == '/metrics' and method == 'GET':
+        return await _send(send, 200, service.metrics.render().encode(), b'text/plain; version=0.0.4')
+    if path in ('/', '/predict', '/ready', '/metrics'):
+        return await _send(send, 405, b'{"error": "Method not allowed"}')
+    return await _send(send, 404, b'{"error": "Not found"}')
@@ -0,0 +1,51 @@
+import numpy as np
+
+# Test-time augmentation views, in the order they are added as more are
+# requested: flips first (free, exact), then 87.5% crops resampled back to
+# full size (centre first, then the corners)
+VIEWS = ('original', 'hflip', 'vflip', 'rot180', 'center_crop', 'center_crop_hflip',
+         'crop_top_left', 'crop_top_right', 'crop_bottom_left', 'crop_bottom_right')
+CROP = 0.875
+
+
+def _crop_index(size, crop, start):
+    """Nearest-neighbour source indices that stretch a crop of `crop` pixels from `start` to `size`"""
+    return start + (np.arange(size) * crop // size)
+
+
+def tta_views(x, n):
+    """Stack the first `n` augmented views of a (1, H, W, 3) tensor into one (n, H, W, 3) batch.
+
+    Every view is a flip and/or a strided or fancy-indexed read of the one
+    decoded image, written straight into its slot of the batch.
+    """
+    if not 1 <= n <= len(VIEWS):
+        raise ValueError(f'TTA views must be between 1 and {len(VIEWS)}')
+    img = x[0]
+    h, w = img.shape[:2]
+    ch, cw = int(h * CROP), int(w * CROP)
+    crops = {
+        'center_crop': ((h - ch) // 2, (w - cw) // 2),
+        'crop_top_left': (0, 0),
+        'crop_top_right': (0, w - cw),
+        'crop_bottom_left': (h - ch, 0),
+        'crop_bottom_right': (h - ch, w - cw),
+    }
+    out = np.empty((n,) + img.shape, dtype=x.dtype)
+    for i, view in enumerate(VIEWS[:n]):
+        if view == 'original':
+            out[i] = img
+        elif view == 'hflip':
+            out[i] = img[:, ::-1]
+        elif view == 'vflip':
+            out[i] = img[::-1]
+        elif view == 'rot180':
+            out[i] = img[::-1, ::-1]
+        else:
+            top, left = crops['center_crop' if view == 'center_crop_hflip' else view]
+            rows = _crop_index(h, ch, top)
+            cols = _crop_index(w, cw, left)
+            if view == 'center_crop_hflip':
+                cols = cols[::-1]
+            out[i] = img[rows[:, None], cols]
+    return out
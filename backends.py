@@ -0,0 +1,294 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import tensorflow as tf
+from keras.models import Model, load_model
+
+from model_store import _file_lock
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def artifact_path(h5_path, backend):
+    """Where convert_model.py writes the artifact for `backend`, next to the .h5"""
+    root, _ = os.path.splitext(h5_path)
+    return {
+        'keras': h5_path,
+        'tflite-dynamic': root + '.dynamic.tflite',
+        'tflite-int8': root + '.int8.tflite',
+        'onnx': root + '.onnx',
+        'keras-mmap': os.path.join(root + '.mmap', 'model.json'),
+    }[backend]
+
+
+class KerasBackend:
+    """The .h5 model run through a traced tf.function instead of model.predict.
+
+    Inputs are padded up to the nearest of `batch_sizes` so only that many
+    graphs are ever traced; larger batches are split into chunks of the
+    biggest size. `warmup` traces them all up front. `embed` returns the
+    penultimate layer (the input of the softmax) instead, traced on first use.
+    """
+
+    def __init__(self, path, num_threads=None, batch_sizes=(1, 8, 32)):
+        self.path = path
+        self.model = load_model(path)
+        self.batch_sizes = sorted(batch_sizes)
+        self._fns = self._trace(self.model)
+        self._embed_fns = None
+        self._embed_lock = threading.Lock()
+
+    def _trace(self, model):
+        fn = tf.function(lambda x: model(x, training=False))
+        return {n: fn.get_concrete_function(tf.TensorSpec((n,) + self.model.input_shape[1:], tf.float32))
+                for n in self.batch_sizes}
+
+    @property
+    def num_classes(self):
+        return self.model.output_shape[-1]
+
+    @property
+    def embedding_size(self):
+        return self.model.layers[-1].input.shape[-1]
+
+    def _run(self, x, fns):
+        n = len(x)
+        size = next(s for s in self.batch_sizes if s >= n)
+        if size != n:
+            x = np.concatenate([x, np.zeros((size - n,) + x.shape[1:], dtype=np.float32)])
+        return fns[size](tf.constant(x)).numpy()[:n]
+
+    def _chunked(self, x, fns):
+        x = np.asarray(x, dtype=np.float32)
+        step = self.batch_sizes[-1]
+        if len(x) <= step:
+            return self._run(x, fns)
+        return np.concatenate([self._run(x[i:i + step], fns) for i in range(0, len(x), step)])
+
+    def predict(self, x):
+        return self._chunked(x, self._fns)
+
+    def embed(self, x):
+        """(n, embedding_size) penultimate-layer activations for a (n, 224, 224, 3) batch"""
+        if self._embed_fns is None:
+            with self._embed_lock:
+                if self._embed_fns is None:
+                    self._embed_fns = self._trace(Model(self.model.inputs, self.model.layers[-1].input))
+        return self._chunked(x, self._embed_fns)
+
+    def warmup(self):
+        for n in self.batch_sizes:
+            self._run(np.zeros((n,) + self.model.input_shape[1:], dtype=np.float32), self._fns)
+
+
+# Trailing layers that export_mmap moves into the NumPy head
+HEAD_LAYERS = ('Dense', 'Dropout', 'BatchNormalization')
+
+
+def export_mmap(h5_path):
+    """Split the .h5 into the keras-mmap artifact read by MmapBackend.
+
+    The trailing run of Dense/Dropout/BatchNormalization layers becomes a
+    list of NumPy ops whose arrays are saved as float32 .npy files: Dense
+    layers keep their kernel, bias and activation, BatchNormalization is
+    folded into a per-feature scale and shift, and Dropout (a no-op at
+    inference) is dropped. Everything before it is saved as prefix.h5.
+    """
+    out_path = artifact_path(h5_path, 'keras-mmap')
+    directory = os.path.dirname(out_path)
+    model = load_model(h5_path)
+    layers = model.layers
+    split = len(layers)
+    while split > 0 and type(layers[split - 1]).__name__ in HEAD_LAYERS:
+        split -= 1
+    if split in (0, len(layers)) or type(layers[-1]).__name__ != 'Dense':
+        raise ValueError('keras-mmap needs a model ending in Dense layers, after at least one other layer')
+    prefix = Model(model.inputs, layers[split - 1].output)
+    if len(prefix.output_shape) != 2:
+        raise ValueError(f'The dense head must take flat features, not {prefix.output_shape}')
+
+    tmp = f'{directory}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    prefix.save(os.path.join(tmp, 'prefix.h5'))
+    head = []
+    for i, layer in enumerate(layers[split:]):
+        kind = type(layer).__name__
+        if kind == 'Dropout':
+            continue
+        if kind == 'BatchNormalization':
+            scale = 1.0 / np.sqrt(np.asarray(layer.moving_variance) + layer.epsilon)
+            if layer.gamma is not None:
+                scale = scale * np.asarray(layer.gamma)
+            shift = -np.asarray(layer.moving_mean) * scale
+            if layer.beta is not None:
+                shift = shift + np.asarray(layer.beta)
+            op, arrays = {'op': 'affine'}, {'scale': scale, 'shift': shift}
+        else:
+            activation = layer.activation.__name__
+            if activation not in ('linear', 'relu', 'softmax'):
+                raise ValueError(f'Unsupported activation {activation!r} in layer {layer.name}')
+            op, arrays = {'op': 'dense', 'activation': activation}, {'kernel': np.asarray(layer.kernel)}
+            if layer.bias is not None:
+                arrays['bias'] = np.asarray(layer.bias)
+        for name, value in arrays.items():
+            op[name] = f'{i}.{name}.npy'
+            np.save(os.path.join(tmp, op[name]), np.ascontiguousarray(value, dtype=np.float32))
+        head.append(op)
+    with open(os.path.join(tmp, os.path.basename(out_path)), 'w') as f:
+        json.dump({'prefix': 'prefix.h5', 'head': head}, f, indent=2)
+    # Processes still serving an earlier export keep their mappings of the removed files
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return out_path
+
+
+def _run_head(x, ops):
+    for op in ops:
+        if op['op'] == 'affine':
+            x = x * op['scale'] + op['shift']
+            continue
+        x = x @ op['kernel']
+        if 'bias' in op:
+            x += op['bias']
+        if op['activation'] == 'relu':
+            np.maximum(x, 0, out=x)
+        elif op['activation'] == 'softmax':
+            x = np.exp(x - x.max(axis=-1, keepdims=True))
+            x /= x.sum(axis=-1, keepdims=True)
+    return x
+
+
+class MmapBackend(KerasBackend):
+    """The model split for multi-process serving (see export_mmap).
+
+    The convolutional prefix runs in Keras as usual; the dense head, which
+    holds most of the weights, runs in NumPy straight from .npy files
+    memory-mapped read-only. Every worker process on the host maps the same
+    files, so the head's pages sit in memory once however many workers
+    there are.
+    """
+
+    def __init__(self, path, num_threads=None, batch_sizes=(1, 8, 32)):
+        directory = os.path.dirname(path)
+        with open(path) as f:
+            spec = json.load(f)
+        super().__init__(os.path.join(directory, spec['prefix']), num_threads, batch_sizes)
+        self.path = path
+        self.head = []
+        for op in spec['head']:
+            op = dict(op)
+            for name in ('kernel', 'bias', 'scale', 'shift'):
+                if name in op:
+                    op[name] = np.asarray(np.load(os.path.join(directory, op[name]), mmap_mode='r'))
+            self.head.append(op)
+
+    @property
+    def num_classes(self):
+        return self.head[-1]['kernel'].shape[1]
+
+    @property
+    def embedding_size(self):
+        return self.head[-1]['kernel'].shape[0]
+
+    def predict(self, x):
+        return _run_head(self._chunked(x, self._fns), self.head)
+
+    def embed(self, x):
+        """(n, embedding_size) input of the final Dense layer for a (n, 224, 224, 3) batch"""
+        return _run_head(self._chunked(x, self._fns), self.head[:-1])
+
+    def warmup(self):
+        super().warmup()
+        # Faults the head's pages in (from the page cache if another worker already read them)
+        self.predict(np.zeros((1,) + self.model.input_shape[1:], dtype=np.float32))
+
+
+class TFLiteBackend:
+    """A (quantized) TFLite flatbuffer. The interpreter is resized to each
+    incoming batch size and is not thread-safe, so calls are serialized."""
+
+    def __init__(self, path, num_threads=None, batch_sizes=(1,)):
+        self.path = path
+        self.batch_sizes = sorted(batch_sizes)
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    @property
+    def num_classes(self):
+        return int(self.interpreter.get_output_details()[0]['shape'][-1])
+
+    def warmup(self):
+        shape = tuple(self.interpreter.get_input_details()[0]['shape'][1:])
+        for n in self.batch_sizes:
+            self.predict(np.zeros((n,) + shape, dtype=np.float32))
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        with self._lock:
+            if self._batch_size != len(x):
+                self.interpreter.resize_tensor_input(self._input, list(x.shape))
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(x)
+            self.interpreter.set_tensor(self._input, x)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
+
+class OnnxBackend:
+    """The model exported to ONNX and run with ONNX Runtime"""
+
+    def __init__(self, path, num_threads=None, batch_sizes=(1,)):
+        if onnxruntime is None:
+            raise RuntimeError('The onnxruntime package is required for the onnx backend')
+        self.path = path
+        self.batch_sizes = sorted(batch_sizes)
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self._input = self.session.get_inputs()[0].name
+
+    @property
+    def num_classes(self):
+        return self.session.get_outputs()[0].shape[-1]
+
+    def predict(self, x):
+        return self.session.run(None, {self._input: np.asarray(x, dtype=np.float32)})[0]
+
+    def warmup(self):
+        shape = [d if isinstance(d, int) else 1 for d in self.session.get_inputs()[0].shape[1:]]
+        for n in self.batch_sizes:
+            self.predict(np.zeros([n] + shape, dtype=np.float32))
+
+
+BACKENDS = {
+    'keras': KerasBackend,
+    'tflite-dynamic': TFLiteBackend,
+    'tflite-int8': TFLiteBackend,
+    'onnx': OnnxBackend,
+    'keras-mmap': MmapBackend,
+}
+
+
+def load_backend(name, h5_path, num_threads=None, batch_sizes=(1, 8, 32)):
+    path = artifact_path(h5_path, name)
+    if name == 'keras-mmap' and not os.path.exists(path):
+        # Needs no calibration data, so the first worker to boot a version
+        # exports it; the others wait and then map the same files
+        with _file_lock(h5_path + '.mmap.lock'):
+            if not os.path.exists(path):
+                export_mmap(h5_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No {name} artifact at {path}; create it with: '
+                                f'python convert_model.py convert {name} --h5 {h5_path}')
+    return BACKENDS[name](path, num_threads=num_threads, batch_sizes=batch_sizes)
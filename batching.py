@@ -0,0 +1,158 @@
+import threading
+import time
+import queue
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+
+class _Request:
+    """A single submitted tensor waiting for its rows of the batched output"""
+
+    def __init__(self, x):
+        self.x = x
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.future = Future()
+
+
+class BatchScheduler:
+    """Coalesce concurrent predict calls into a single forward pass.
+
+    Callers hand `predict` a (n, 224, 224, 3) tensor exactly as they would to
+    `model.predict`; the worker thread gathers queued tensors until either
+    `max_batch_size` rows are collected or `max_wait_ms` has passed since the
+    first one arrived, runs one forward pass and fans the rows back out.
+    `on_batch(rows)`, if given, is called with the size of every batch run.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=10, max_queue=0, on_batch=None):
+        self.predict_fn = predict_fn
+        self.on_batch = on_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        # Bounded: once max_queue requests are waiting, submitters block
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._batch_sizes = {}
+        self._batches = 0
+        self._items = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._closed = False
+        self._submit_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._worker.start()
+
+    def submit(self, x):
+        """Queue `x` without waiting; the request's `future` resolves to its rows.
+        Blocks only while `max_queue` requests are already waiting."""
+        req = _Request(x)
+        with self._submit_lock:
+            if not self._closed:
+                self._queue.put(req)
+                return req
+        # Closed (e.g. the model version was swapped out): run unbatched, on a
+        # thread of its own so submit still returns at once (the ASGI app
+        # calls it from the event loop)
+        threading.Thread(target=self._run_one, args=(req,), name='batch-unbatched', daemon=True).start()
+        return req
+
+    def _run_one(self, req):
+        req.started_at = time.perf_counter()
+        try:
+            req.future.set_result(self.predict_fn(req.x))
+        except Exception as e:
+            req.future.set_exception(e)
+
+    def close(self):
+        """Stop the worker thread once the requests already queued are served"""
+        with self._submit_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def predict(self, x, timeout=None, timings=None):
+        """Rows of the batched output for `x`; the time spent queued before
+        the forward pass is recorded under 'queue' in `timings` if given"""
+        req = self.submit(x)
+        try:
+            result = req.future.result(timeout)
+        except FutureTimeoutError:
+            raise TimeoutError('Timed out waiting for batched prediction')
+        if timings is not None:
+            timings['queue'] = req.started_at - req.enqueued_at
+        return result
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None, 0
+        batch = [first]
+        rows = len(first.x)
+        deadline = first.enqueued_at + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if req is None:
+                # Closing: serve this batch, then stop at the next _collect
+                self._queue.put(None)
+                break
+            batch.append(req)
+            rows += len(req.x)
+        return batch, rows
+
+    def _run(self):
+        while True:
+            batch, rows = self._collect()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            for req in batch:
+                req.started_at = started
+            try:
+                x = batch[0].x if len(batch) == 1 else np.concatenate([r.x for r in batch])
+                preds = self.predict_fn(x)
+            except Exception as e:
+                for req in batch:
+                    req.future.set_exception(e)
+                continue
+
+            offset = 0
+            for req in batch:
+                n = len(req.x)
+                req.future.set_result(preds[offset:offset + n])
+                offset += n
+
+            self._record(batch, rows, started)
+
+    def _record(self, batch, rows, started):
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_sizes[rows] = self._batch_sizes.get(rows, 0) + 1
+            for req in batch:
+                waited = started - req.enqueued_at
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+        if self.on_batch is not None:
+            self.on_batch(rows)
+
+    def stats(self):
+        """Queue depth, batch-size histogram and queue wait times"""
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': self._batches,
+                'requests': self._items,
+                'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                'avg_wait_ms': (self._wait_total / self._items * 1000.0) if self._items else 0.0,
+                'max_wait_ms_observed': self._wait_max * 1000.0,
+            }
@@ -0,0 +1,297 @@
+"""Latency and throughput benchmarks for the prediction service.
+
+    python bench.py stages --synthetic                  # per-stage microbenchmarks
+    python bench.py load --synthetic --serve --concurrency 16 --duration 30
+    python bench.py load --url http://host:8000 --rate 50 --duration 60 --output results.json
+
+--synthetic builds a randomly initialised model with the same architecture as
+the notebook's build_model, so both modes run on a CPU-only box without the
+real weights. Results are printed and, with --output, written as JSON tagged
+with the current git commit so runs can be compared across commits.
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import numpy as np
+from PIL import Image
+
+
+def build_model(num_classes=38, img_size=224):
+    """The notebook's AlexNet-style network, randomly initialised"""
+    from keras.models import Sequential
+    from keras.layers import Input, Convolution2D, MaxPooling2D, Flatten, Dense, Dropout, BatchNormalization
+
+    model = Sequential()
+    model.add(Input((img_size, img_size, 3)))
+    model.add(Convolution2D(96, 11, strides=(4, 4), padding='valid', activation='relu'))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid'))
+    model.add(BatchNormalization())
+    model.add(Convolution2D(256, 11, strides=(1, 1), padding='valid', activation='relu'))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid'))
+    model.add(BatchNormalization())
+    model.add(Convolution2D(384, 3, strides=(1, 1), padding='valid', activation='relu'))
+    model.add(BatchNormalization())
+    model.add(Convolution2D(384, 3, strides=(1, 1), padding='valid', activation='relu'))
+    model.add(BatchNormalization())
+    model.add(Convolution2D(256, 3, strides=(1, 1), padding='valid', activation='relu'))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid'))
+    model.add(BatchNormalization())
+    model.add(Flatten())
+    model.add(Dense(4096, activation='relu'))
+    model.add(Dropout(0.4))
+    model.add(BatchNormalization())
+    model.add(Dense(4096, activation='relu'))
+    model.add(Dropout(0.4))
+    model.add(BatchNormalization())
+    model.add(Dense(1000, activation='relu'))
+    model.add(Dropout(0.2))
+    model.add(BatchNormalization())
+    model.add(Dense(num_classes, activation='softmax'))
+    return model
+
+
+def synthetic_model_path():
+    path = os.path.join(tempfile.gettempdir(), 'plant_disease_synthetic.h5')
+    if not os.path.exists(path):
+        print(" ** Building synthetic model **")
+        build_model().save(path)
+    return path
+
+
+def synthetic_photo(width=4032, height=3024, seed=0):
+    """A JPEG the size of a 12MP phone photo: smooth gradients plus sensor-like noise"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([60 + 40 * np.sin(xx / 300), 140 + 50 * np.cos(yy / 250), 50 + 20 * np.sin((xx + yy) / 400)], axis=2)
+    img = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+def summarize(samples_ms):
+    a = np.asarray(samples_ms)
+    if not len(a):
+        return {'count': 0}
+    return {
+        'count': int(len(a)),
+        'mean_ms': float(a.mean()),
+        'p50_ms': float(np.percentile(a, 50)),
+        'p95_ms': float(np.percentile(a, 95)),
+        'p99_ms': float(np.percentile(a, 99)),
+        'max_ms': float(a.max()),
+    }
+
+
+def _time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return summarize(samples)
+
+
+def run_stages(args):
+    if args.synthetic:
+        os.environ['MODEL_FILE'] = synthetic_model_path()
+    # Measure the stages in isolation: no batching delay, no cache hits
+    os.environ.setdefault('BATCH_ENABLED', '0')
+    os.environ.setdefault('CACHE_ENABLED', '0')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    from preprocessing import IMG_SIZE, load_rgb, _SCALE
+
+    data = open(args.image, 'rb').read() if args.image else synthetic_photo()
+    img = Image.open(io.BytesIO(data))
+    print(f" ** Benchmarking stages on a {img.size[0]}x{img.size[1]} {img.format} ({len(data)} bytes) **")
+
+    def decode_full():
+        Image.open(io.BytesIO(data)).load()
+
+    decoded = load_rgb(io.BytesIO(data))
+    pixels = np.asarray(decoded)
+    out = np.empty((IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    x1 = app.preprocess_image(io.BytesIO(data))
+    xb = np.repeat(x1, args.batch_size, axis=0)
+    model = app.registry.active.backend
+    d = model.predict(x1)[0]
+    scored = app.score_prediction(d)
+
+    results = {
+        'decode_full': _time(decode_full, args.repeat),
+        'decode_resize': _time(lambda: load_rgb(io.BytesIO(data)), args.repeat),
+        'normalize': _time(lambda: np.multiply(pixels, _SCALE, out=out), args.repeat),
+        'preprocess_total': _time(lambda: app.preprocess_image(io.BytesIO(data)), args.repeat),
+        'forward_batch_1': _time(lambda: model.predict(x1), args.repeat),
+        f'forward_batch_{args.batch_size}': _time(lambda: model.predict(xb), max(1, args.repeat // 4)),
+        'serialize_render': _time(lambda: app.label_index.render(*scored), args.repeat),
+        'serialize_json_dumps': _time(lambda: json.dumps(app.label_index.as_dict(*scored)), args.repeat),
+    }
+    for name, r in results.items():
+        print(f"{name:>24}: p50 {r['p50_ms']:9.3f} ms  p99 {r['p99_ms']:9.3f} ms")
+    return {'mode': 'stages', 'backend': app.INFERENCE_BACKEND, 'image_bytes': len(data), 'results': results}
+
+
+def _multipart(data, filename='leaf.jpg'):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def _serve(port, synthetic):
+    env = dict(os.environ, BIND=f'127.0.0.1:{port}')
+    # The load generator reuses a handful of images; measure inference, not cache hits
+    env.setdefault('CACHE_ENABLED', '0')
+    if synthetic:
+        env['MODEL_FILE'] = synthetic_model_path()
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(here, 'gunicorn.conf.py'), 'app:app'],
+                            cwd=here, env=env)
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit('Server exited during startup')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/ready')
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise SystemExit('Server did not become ready')
+
+
+def _answered(status, body):
+    """Whether a response carries a prediction: /predict also answers 200
+    for images it failed on or rejected, with an error in the body"""
+    if status != 200:
+        return False
+    try:
+        result = json.loads(body)
+    except ValueError:
+        return False
+    results = result.get('results', [result]) if isinstance(result, dict) else []
+    return bool(results) and all(isinstance(r, dict) and 'error' not in r and not r.get('rejected')
+                                 and r.get('crop') != 'Error' for r in results)
+
+
+def run_load(args):
+    proc = _serve(args.port, args.synthetic) if args.serve else None
+    url = urllib.parse.urlsplit(args.url or f'http://127.0.0.1:{args.port}')
+    path = url.path.rstrip('/') + args.path
+    images = [open(p, 'rb').read() for p in args.image] if args.image else [
+        synthetic_photo(1600, 1200, seed=i) for i in range(8)]
+    bodies = [_multipart(d) for d in images]
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + args.duration
+
+    def one_request(conn):
+        body, content_type = random.choice(bodies)
+        start = time.perf_counter()
+        try:
+            conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+            resp = conn.getresponse()
+            ok = _answered(resp.status, resp.read())
+        except OSError:
+            ok = False
+            conn.close()
+        elapsed = (time.perf_counter() - start) * 1000.0
+        with lock:
+            (latencies if ok else errors).append(elapsed)
+
+    def closed_loop():
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+        while time.perf_counter() < stop_at:
+            one_request(conn)
+
+    threads = []
+    started = time.perf_counter()
+    if args.rate:
+        # Open loop: Poisson arrivals at --rate per second, each on its own thread
+        # so a slow server can't slow the arrival rate down
+        next_at = started
+        while next_at < stop_at:
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+            t = threading.Thread(target=lambda: one_request(http.client.HTTPConnection(url.hostname, url.port, timeout=60)))
+            t.start()
+            threads.append(t)
+            next_at += random.expovariate(args.rate)
+    else:
+        threads = [threading.Thread(target=closed_loop) for _ in range(args.concurrency)]
+        for t in threads:
+            t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    if proc is not None:
+        proc.terminate()
+        proc.wait()
+
+    summary = summarize(latencies)
+    summary.update(errors=len(errors), throughput_rps=len(latencies) / wall, wall_s=wall)
+    print(f" ** {summary['count']} ok / {len(errors)} errors in {wall:.1f}s: "
+          f"{summary['throughput_rps']:.1f} req/s, p50 {summary.get('p50_ms', 0):.1f} ms, "
+          f"p95 {summary.get('p95_ms', 0):.1f} ms, p99 {summary.get('p99_ms', 0):.1f} ms **")
+    return {'mode': 'load', 'path': path, 'concurrency': args.concurrency, 'rate': args.rate,
+            'duration_s': args.duration, 'results': summary}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('stages', help='Time decode, resize, normalize, forward pass and serialization separately')
+    p.add_argument('--image', help='Image to benchmark with (default: a synthetic 12MP JPEG)')
+    p.add_argument('--repeat', type=int, default=50)
+    p.add_argument('--batch-size', type=int, default=32)
+
+    p = sub.add_parser('load', help='Drive the HTTP service and report throughput and latency percentiles')
+    p.add_argument('--url', help='Base URL of a running server (default: the one started by --serve)')
+    p.add_argument('--serve', action='store_true', help='Start a local gunicorn server for the run')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--path', default='/predict')
+    p.add_argument('--image', action='append', help='Image(s) to upload (default: synthetic photos)')
+    p.add_argument('--concurrency', type=int, default=8, help='Closed-loop clients')
+    p.add_argument('--rate', type=float, help='Open-loop arrival rate in requests/second instead of --concurrency')
+    p.add_argument('--duration', type=float, default=30)
+
+    for p in sub.choices.values():
+        p.add_argument('--synthetic', action='store_true', help='Use a randomly initialised model of the same architecture')
+        p.add_argument('--output', help='Write results as JSON to this file')
+
+    args = parser.parse_args(argv)
+    result = run_stages(args) if args.command == 'stages' else run_load(args)
+    result.update(commit=_git_commit(), timestamp=time.time(), cpu_count=os.cpu_count())
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def file_fingerprint(path):
+    """Cheap identity for a model file: changes whenever the file is replaced"""
+    st = os.stat(path)
+    return hashlib.sha1(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'.encode()).hexdigest()[:16]
+
+
+def content_key(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def perceptual_key(x):
+    """Average hash of a preprocessed (1, 224, 224, 3) tensor, robust to re-encoding"""
+    gray = x[0].mean(axis=2)
+    blocks = gray.reshape(8, gray.shape[0] // 8, 8, gray.shape[1] // 8).mean(axis=(1, 3))
+    bits = (blocks > blocks.mean()).flatten()
+    return 'ahash:' + format(int(''.join('1' if b else '0' for b in bits), 2), '016x')
+
+
+class FileCacheTier:
+    """Shared tier storing one JSON file per key, visible to every worker on the node.
+
+    Expired entries are deleted when read, and at most every
+    `prune_interval` seconds a put sweeps the whole directory: it deletes
+    expired files, the emptied directories of old model versions, and the
+    oldest files beyond `max_entries`.
+    """
+
+    def __init__(self, directory, max_entries=100000, prune_interval=60):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self._ttl = None
+        self._next_prune = 0.0
+        self._prune_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, namespace, key):
+        return os.path.join(self.directory, namespace, key.replace(':', '_') + '.json')
+
+    def get(self, namespace, key):
+        try:
+            with open(self._path(namespace, key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] < time.time():
+            self._remove(self._path(namespace, key))
+            return None
+        return entry['value']
+
+    def put(self, namespace, key, value, ttl):
+        path = self._path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'expires': time.time() + ttl, 'value': value}, f)
+        os.replace(tmp, path)
+        self._ttl = ttl
+        if time.time() >= self._next_prune and self._prune_lock.acquire(blocking=False):
+            try:
+                self.prune()
+            finally:
+                self._prune_lock.release()
+
+    @staticmethod
+    def _remove(path):
+        # Another worker may have removed it first
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Delete expired entries, empty namespaces and the oldest entries over `max_entries`"""
+        self._next_prune = time.time() + self.prune_interval
+        # Every entry is written with the same ttl, so its mtime tells when it expires
+        cutoff = time.time() - self._ttl if self._ttl is not None else None
+        kept = []
+        for namespace in os.scandir(self.directory):
+            if not namespace.is_dir():
+                continue
+            empty = True
+            for entry in os.scandir(namespace.path):
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if cutoff is not None and mtime < cutoff:
+                    self._remove(entry.path)
+                else:
+                    kept.append((mtime, entry.path))
+                    empty = False
+            if empty:
+                try:
+                    os.rmdir(namespace.path)
+                except OSError:
+                    pass
+        if len(kept) > self.max_entries:
+            kept.sort()
+            for _, path in kept[:len(kept) - self.max_entries]:
+                self._remove(path)
+
+
+class RedisCacheTier:
+    """Shared tier backed by any Redis-compatible server"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('The redis package is required for a redis:// cache URL')
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, namespace, key):
+        value = self.client.get(f'{namespace}:{key}')
+        return json.loads(value) if value is not None else None
+
+    def put(self, namespace, key, value, ttl):
+        self.client.set(f'{namespace}:{key}', json.dumps(value), ex=int(ttl))
+
+
+def shared_tier_from_url(url, max_entries=100000):
+    """The shared tier for CACHE_SHARED_URL; `max_entries` caps a file tier (Redis evicts by itself)"""
+    if not url:
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisCacheTier(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return FileCacheTier(url, max_entries=max_entries)
+
+
+class PredictionCache:
+    """Two-tier cache of softmax rows: a bounded LRU/TTL dict per process in
+    front of an optional shared tier. Entries are namespaced by the model
+    fingerprint so swapping the model file invalidates everything.
+
+    `get` and `put` take the namespace of the model the caller is running,
+    captured before inference: if the active model changes meanwhile, its
+    result only goes to the shared tier under the model that produced it.
+    """
+
+    def __init__(self, namespace, max_entries=10000, ttl=3600, shared=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def set_namespace(self, namespace):
+        with self._lock:
+            if namespace != self.namespace:
+                self.namespace = namespace
+                self._entries.clear()
+
+    def get(self, key, namespace=None):
+        now = time.time()
+        with self._lock:
+            namespace = namespace or self.namespace
+            entry = self._entries.get(key) if namespace == self.namespace else None
+            if entry is not None:
+                if entry[0] >= now:
+                    self._entries.move_to_end(key)
+                    self._counts['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._counts['expirations'] += 1
+
+        value = None
+        if self.shared is not None:
+            try:
+                value = self.shared.get(namespace, key)
+            except Exception as e:
+                print(f"Error reading shared cache: {str(e)}")
+        with self._lock:
+            if value is None:
+                self._counts['misses'] += 1
+            else:
+                self._counts['shared_hits'] += 1
+                if namespace == self.namespace:
+                    self._store(key, value, now)
+        return value
+
+    def put(self, key, value, namespace=None):
+        with self._lock:
+            namespace = namespace or self.namespace
+            if namespace == self.namespace:
+                self._store(key, value, time.time())
+        if self.shared is not None:
+            try:
+                self.shared.put(namespace, key, value, self.ttl)
+            except Exception as e:
+                print(f"Error writing shared cache: {str(e)}")
+
+    def _store(self, key, value, now):
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counts['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counts['hits'] + self._counts['shared_hits'] + self._counts['misses']
+            hits = self._counts['hits'] + self._counts['shared_hits']
+            return dict(self._counts,
+                        namespace=self.namespace,
+                        entries=len(self._entries),
+                        max_entries=self.max_entries,
+                        hit_ratio=(hits / lookups) if lookups else 0.0)
@@ -0,0 +1,29 @@
+import json
+
+import numpy as np
+
+
+def load_temperature(path):
+    """Read the temperature-scaling factor from a JSON file like {"temperature": 1.4}"""
+    if not path:
+        return 1.0
+    with open(path) as f:
+        return float(json.load(f)['temperature'])
+
+
+def calibrate(probs, temperature):
+    """Temperature-scale softmax outputs. The model only exposes probabilities,
+    so the logits are recovered (up to a constant) as log(p)."""
+    if temperature == 1.0:
+        return probs
+    logits = np.log(np.clip(probs, 1e-12, 1.0)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    e = np.exp(logits)
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def top_k(probs, k):
+    """Indices of the k largest probabilities, highest first, without a full sort"""
+    k = min(k, len(probs))
+    idx = np.argpartition(probs, -k)[-k:]
+    return idx[np.argsort(probs[idx])[::-1]]
@@ -0,0 +1,116 @@
+"""Convert the .h5 model into the alternative inference backends and check
+that a converted backend agrees with the original.
+
+    python convert_model.py convert tflite-dynamic --h5 /path/to/plant_disease_model.h5
+    python convert_model.py convert tflite-int8 --h5 ... --calibration-dir samples/
+    python convert_model.py convert onnx --h5 ...
+    python convert_model.py convert keras-mmap --h5 ...
+    python convert_model.py parity tflite-int8 --h5 ... --images heldout/
+"""
+import argparse
+import itertools
+import sys
+
+import numpy as np
+import tensorflow as tf
+from keras.models import load_model
+
+from backends import BACKENDS, KerasBackend, artifact_path, export_mmap, load_backend
+from preprocessing import IMG_SIZE, iter_image_files, preprocess_image
+
+
+def _batches(paths, batch_size):
+    paths = iter(paths)
+    while True:
+        chunk = list(itertools.islice(paths, batch_size))
+        if not chunk:
+            return
+        yield chunk, np.concatenate([preprocess_image(p) for p in chunk]).astype(np.float32)
+
+
+def convert(backend, h5_path, calibration_dir=None, calibration_samples=200):
+    if backend == 'keras-mmap':
+        out_path = export_mmap(h5_path)
+        print(f" ** Wrote {backend} model to {out_path} **")
+        return out_path
+    model = load_model(h5_path)
+    out_path = artifact_path(h5_path, backend)
+
+    if backend in ('tflite-dynamic', 'tflite-int8'):
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if backend == 'tflite-int8':
+            if not calibration_dir:
+                raise SystemExit('tflite-int8 needs --calibration-dir with representative images')
+            paths = list(itertools.islice(iter_image_files(calibration_dir), calibration_samples))
+
+            def representative_dataset():
+                for p in paths:
+                    yield [preprocess_image(p).astype(np.float32)]
+
+            # Integer kernels throughout, float32 in and out so callers don't change
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        with open(out_path, 'wb') as f:
+            f.write(converter.convert())
+    elif backend == 'onnx':
+        import tf2onnx
+        spec = [tf.TensorSpec((None, IMG_SIZE, IMG_SIZE, 3), tf.float32, name='input')]
+        tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=out_path)
+    else:
+        raise SystemExit(f'Nothing to convert for backend {backend!r}')
+
+    print(f" ** Wrote {backend} model to {out_path} **")
+    return out_path
+
+
+def parity(backend, h5_path, images_dir, batch_size=32, min_agreement=0.99):
+    """Compare top-1 predictions of `backend` against the Keras model"""
+    reference = KerasBackend(h5_path)
+    candidate = load_backend(backend, h5_path)
+    total = agree = 0
+    max_abs_diff = 0.0
+    for paths, x in _batches(iter_image_files(images_dir), batch_size):
+        expected = reference.predict(x)
+        actual = candidate.predict(x)
+        for path, e, a in zip(paths, expected, actual):
+            if np.argmax(e) != np.argmax(a):
+                print(f"Mismatch: {path} keras={np.argmax(e)} {backend}={np.argmax(a)}")
+        agree += int(np.sum(np.argmax(expected, axis=1) == np.argmax(actual, axis=1)))
+        total += len(paths)
+        max_abs_diff = max(max_abs_diff, float(np.abs(expected - actual).max()))
+
+    if total == 0:
+        raise SystemExit(f'No images found under {images_dir}')
+    ratio = agree / total
+    print(f"Top-1 agreement: {agree}/{total} ({ratio:.2%}), max |p diff| {max_abs_diff:.4f}")
+    return ratio >= min_agreement
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('convert', help='Write a backend artifact next to the .h5')
+    p.add_argument('backend', choices=[b for b in BACKENDS if b != 'keras'])
+    p.add_argument('--h5', required=True)
+    p.add_argument('--calibration-dir', help='Representative images for int8 quantization')
+    p.add_argument('--calibration-samples', type=int, default=200)
+
+    p = sub.add_parser('parity', help='Check top-1 agreement with the Keras model')
+    p.add_argument('backend', choices=list(BACKENDS))
+    p.add_argument('--h5', required=True)
+    p.add_argument('--images', required=True, help='Folder of held-out images')
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--min-agreement', type=float, default=0.99)
+
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        convert(args.backend, args.h5, args.calibration_dir, args.calibration_samples)
+        return 0
+    ok = parity(args.backend, args.h5, args.images, args.batch_size, args.min_agreement)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
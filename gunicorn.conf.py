@@ -0,0 +1,32 @@
+# Gunicorn settings for serving app.py: gunicorn app:app
+#
+# TensorFlow's runtime is not fork-safe, so the model cannot be loaded in the
+# master and shared copy-on-write with forked workers (workers hang on their
+# first predict). Instead, each worker process holds one copy of the model and
+# serves many requests from threads: TensorFlow releases the GIL inside ops,
+# and the micro-batching scheduler merges concurrent requests into one forward
+# pass. Scale threads first, worker processes only when one process can't keep
+# the cores busy.
+#
+# With more than one worker process, serve with INFERENCE_BACKEND=keras-mmap.
+# Its dense head, most of the weights, is read from .npy files that every
+# worker memory-maps read-only, so those pages are in memory once per node
+# rather than once per worker; only the convolutional layers are loaded per
+# process. The plain keras backend holds a full private copy in every worker.
+# The head runs on NumPy's BLAS, whose threads are split between the workers
+# below the same way TF_INTRA_OP_THREADS splits TensorFlow's.
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+for _var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(_var, str(max(1, (os.cpu_count() or 1) // workers)))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# Workers load the model before answering the master's heartbeat, and a cold
+# boot (download, load, warm-up of every batch size) can take minutes; a
+# worker killed mid-boot is restarted and starts over. Other workers wait on
+# the model store lock instead of downloading it again. For predictable
+# boots, pre-warm MODEL_CACHE_DIR (e.g. in the image build) and run with
+# MODEL_OFFLINE=1 so a missing model fails fast instead of downloading.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
@@ -0,0 +1,56 @@
+import gzip
+import hashlib
+import json
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CachedResource:
+    """An immutable JSON document with pre-compressed gzip/brotli variants,
+    all computed once up front. Each variant has its own strong ETag, since
+    the bytes on the wire differ."""
+
+    def __init__(self, obj, max_age=86400):
+        self.body = json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+        self._digest = hashlib.sha256(self.body).hexdigest()[:32]
+        self.max_age = max_age
+        self.encodings = {'gzip': gzip.compress(self.body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(self.body, quality=11)
+
+    def _pick_encoding(self):
+        accepted = request.accept_encodings
+        best = None
+        for name in ('br', 'gzip'):
+            if name in self.encodings and accepted[name] and (
+                    best is None or len(self.encodings[name]) < len(self.encodings[best])):
+                best = name
+        return best
+
+    def etag(self, encoding=None):
+        """Unquoted strong entity tag for the given variant"""
+        return f'{self._digest}-{encoding}' if encoding else self._digest
+
+    def response(self, response_class):
+        encoding = self._pick_encoding()
+        headers = {
+            'ETag': f'"{self.etag(encoding)}"',
+            'Cache-Control': f'public, max-age={self.max_age}',
+            'Vary': 'Accept-Encoding',
+        }
+        # If-None-Match uses weak comparison (RFC 9110 13.1.2). A CDN that
+        # re-compresses the body weakens the tag and may swap the variant
+        # suffix, but every variant carries the same document
+        if request.if_none_match.star_tag or any(request.if_none_match.contains_weak(self.etag(e))
+                                                 for e in (None, *self.encodings)):
+            return response_class(status=304, headers=headers)
+
+        if encoding is None:
+            return response_class(self.body, mimetype='application/json', headers=headers)
+        headers['Content-Encoding'] = encoding
+        return response_class(self.encodings[encoding], mimetype='application/json', headers=headers)
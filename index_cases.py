@@ -0,0 +1,91 @@
+"""Embed labelled images into the similar-case index served at /similar.
+
+    python index_cases.py dataset/train/ --h5 model.h5 --index /data/cases
+    python index_cases.py confirmed.csv --h5 model.h5 --index /data/cases --batch-size 128
+    python index_cases.py --build-only --h5 model.h5 --index /data/cases --nlist 4096
+
+A directory is read as <label>/<image> (the training dataset layout); a
+CSV manifest needs 'path' and 'label' columns. Embeddings are the model's
+penultimate layer. New cases are appended to whatever the index already
+holds, then the IVF lists are rebuilt over all of them.
+"""
+import argparse
+import csv
+import itertools
+import os
+import sys
+
+from backends import load_backend
+from model_store import sha256_file
+from preprocessing import DecodePool, iter_image_files
+from vector_index import VectorIndex
+
+
+def iter_labelled(source):
+    """Yield (path, label) pairs"""
+    if os.path.isdir(source):
+        for path in iter_image_files(source):
+            yield path, os.path.relpath(path, source).split(os.sep)[0]
+    elif source.lower().endswith('.csv'):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            for row in csv.DictReader(f):
+                yield os.path.join(base, row['path']), row['label']
+    else:
+        raise SystemExit(f'Unsupported input {source!r}: expected a directory or .csv manifest')
+
+
+def index_cases(source, h5_path, index_dir, batch_size=64, decode_workers=4):
+    model = load_backend('keras', h5_path, batch_sizes=(batch_size,))
+    index = VectorIndex(index_dir, model.embedding_size)
+    index.set_meta('model_sha256', sha256_file(model.path))
+    decode_pool = DecodePool(decode_workers)
+
+    inputs = iter_labelled(source)
+    added = 0
+    for chunk in iter(lambda: list(itertools.islice(inputs, batch_size)), []):
+        datas = []
+        for path, _ in chunk:
+            try:
+                with open(path, 'rb') as f:
+                    datas.append(f.read())
+            except OSError:
+                datas.append(b'')
+        x, errors = decode_pool.decode_batch(datas)
+        ok = [i for i, e in enumerate(errors) if e is None]
+        for i, e in enumerate(errors):
+            if e is not None:
+                print(f"Skipping {chunk[i][0]}: {e}")
+        if ok:
+            index.add(model.embed(x if len(ok) == len(chunk) else x[ok]),
+                      [chunk[i][1] for i in ok], [chunk[i][0] for i in ok])
+            added += len(ok)
+        print(f" ** Embedded {added} images **")
+    return index, added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('source', nargs='?', help='Directory of <label>/<image> or CSV manifest with path and label')
+    parser.add_argument('--h5', required=True, help='Path to the .h5 model the service runs')
+    parser.add_argument('--index', required=True, help='Index directory (EMBEDDING_INDEX_DIR)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--nlist', type=int, default=None, help='IVF lists (default: sqrt of the number of cases)')
+    parser.add_argument('--build-only', action='store_true', help='Only rebuild the IVF lists')
+    args = parser.parse_args(argv)
+    if not args.build_only and not args.source:
+        parser.error('a source is required unless --build-only is given')
+
+    if args.build_only:
+        model = load_backend('keras', args.h5, batch_sizes=(1,))
+        index = VectorIndex(args.index, model.embedding_size)
+    else:
+        index, _ = index_cases(args.source, args.h5, args.index, args.batch_size, args.decode_workers)
+    nlist = index.build(args.nlist)
+    print(f" ** Indexed {len(index)} cases into {nlist} lists **")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
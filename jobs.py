@@ -0,0 +1,264 @@
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MemoryJobStore:
+    """Keeps jobs in process memory; they are lost on restart"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id, items):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {'id': job_id, 'status': 'queued', 'created': now, 'updated': now,
+                                  'count': len(items), 'results': None, 'items': items}
+
+    def claim(self, job_id):
+        """Mark a queued job running and return its items, or None if someone else has it"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                return None
+            job['status'] = 'running'
+            job['updated'] = time.time()
+            return job.pop('items')
+
+    def finish(self, job_id, status, results):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(status=status, results=results, updated=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {k: v for k, v in job.items() if k != 'items'}
+
+    def renew(self, job_ids):
+        pass
+
+    def unfinished(self):
+        return []
+
+    def requeue_expired(self):
+        return []
+
+    def prune(self, older_than):
+        with self._lock:
+            for job_id in [j['id'] for j in self._jobs.values()
+                           if j['status'] in ('done', 'failed') and j['updated'] < older_than]:
+                del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """Durable store in a SQLite file: queued jobs and their images survive a restart.
+
+    The file can be shared by several worker processes. A worker claiming a
+    job takes a lease on it for `lease` seconds and keeps renewing it while
+    the job runs; only jobs whose lease has run out (their worker died) are
+    put back in the queue, so a sibling's running jobs are never re-run.
+    """
+
+    def __init__(self, path, lease=60):
+        self.path = path
+        self.lease = lease
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    results TEXT,
+                    owner TEXT,
+                    lease_until REAL
+                );
+                CREATE TABLE IF NOT EXISTS job_items (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    filename TEXT,
+                    data BLOB,
+                    error TEXT,
+                    PRIMARY KEY (job_id, idx)
+                );
+            ''')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, kind in (('owner', 'TEXT'), ('lease_until', 'REAL')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {kind}')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, job_id, items):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute('INSERT INTO jobs (id, status, created, updated, count) VALUES (?, ?, ?, ?, ?)',
+                         (job_id, 'queued', now, now, len(items)))
+            conn.executemany('INSERT INTO job_items VALUES (?, ?, ?, ?, ?)',
+                             [(job_id, i, item.get('filename'), item.get('data'), item.get('error'))
+                              for i, item in enumerate(items)])
+
+    def claim(self, job_id):
+        with self._conn() as conn:
+            now = time.time()
+            cur = conn.execute("UPDATE jobs SET status = 'running', updated = ?, owner = ?, lease_until = ? "
+                               "WHERE id = ? AND status = 'queued'", (now, self.owner, now + self.lease, job_id))
+            if cur.rowcount != 1:
+                return None
+            rows = conn.execute('SELECT filename, data, error FROM job_items WHERE job_id = ? ORDER BY idx',
+                                (job_id,)).fetchall()
+        items = []
+        for filename, data, error in rows:
+            item = {'filename': filename}
+            if error is not None:
+                item['error'] = error
+            else:
+                item['data'] = bytes(data)
+            items.append(item)
+        return items
+
+    def finish(self, job_id, status, results):
+        with self._conn() as conn:
+            conn.execute('UPDATE jobs SET status = ?, results = ?, updated = ? WHERE id = ?',
+                         (status, json.dumps(results), time.time(), job_id))
+            conn.execute('DELETE FROM job_items WHERE job_id = ?', (job_id,))
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT id, status, created, updated, count, results FROM jobs WHERE id = ?',
+                                   (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'status': row[1], 'created': row[2], 'updated': row[3], 'count': row[4],
+                'results': json.loads(row[5]) if row[5] is not None else None}
+
+    def renew(self, job_ids):
+        """Extend the lease on jobs this worker is still running"""
+        if not job_ids:
+            return
+        with self._conn() as conn:
+            conn.execute(f"UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running' "
+                         f"AND id IN ({','.join('?' * len(job_ids))})",
+                         [time.time() + self.lease, self.owner] + list(job_ids))
+
+    def requeue_expired(self):
+        """Put running jobs whose worker stopped renewing their lease back in the queue; returns their ids"""
+        with self._conn() as conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM jobs WHERE status = 'running' "
+                                              "AND (lease_until IS NULL OR lease_until < ?)", (time.time(),))]
+            for job_id in ids:
+                conn.execute("UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL "
+                             "WHERE id = ? AND status = 'running'", (job_id,))
+        return ids
+
+    def unfinished(self):
+        """Queued jobs plus those interrupted by a crash or restart"""
+        self.requeue_expired()
+        return [r[0] for r in self._conn().execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created")]
+
+    def prune(self, older_than):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (older_than,))
+
+
+class JobManager:
+    """Bounded job queue drained by a fixed pool of worker threads.
+
+    `handler` receives a job's items and returns its results. `submit` raises
+    QueueFull once `max_queue` jobs are waiting, which callers turn into a 429.
+    """
+
+    def __init__(self, store, handler, workers=2, max_queue=100, ttl=3600):
+        self.store = store
+        self.handler = handler
+        self.ttl = ttl
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Recovered jobs may exceed max_queue; they were accepted before the restart
+        self._recovered = list(store.unfinished())
+        self._recovered_lock = threading.Lock()
+        self._running = set()
+        self._threads = [threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+        lease = getattr(store, 'lease', None)
+        if lease:
+            threading.Thread(target=self._heartbeat, args=(lease / 3.0,), name='job-heartbeat', daemon=True).start()
+
+    def submit(self, items):
+        self.store.prune(time.time() - self.ttl)
+        job_id = uuid.uuid4().hex
+        if self._queue.full():
+            raise QueueFull()
+        self.store.create(job_id, items)
+        try:
+            self._queue.put_nowait(job_id)
+        except queue.Full:
+            self.store.finish(job_id, 'failed', {'error': 'Job queue is full'})
+            raise QueueFull()
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._recovered)
+
+    def _next(self):
+        with self._recovered_lock:
+            if self._recovered:
+                return self._recovered.pop(0)
+        return self._queue.get()
+
+    def _heartbeat(self, interval):
+        """Renew the leases on running jobs and pick up jobs abandoned by dead workers"""
+        while True:
+            time.sleep(interval)
+            try:
+                with self._recovered_lock:
+                    running = list(self._running)
+                self.store.renew(running)
+                expired = self.store.requeue_expired()
+                if expired:
+                    with self._recovered_lock:
+                        self._recovered.extend(expired)
+            except Exception as e:
+                print(f"Error renewing job leases: {str(e)}")
+
+    def _run(self):
+        while True:
+            job_id = self._next()
+            items = self.store.claim(job_id)
+            if items is None:
+                continue
+            with self._recovered_lock:
+                self._running.add(job_id)
+            try:
+                self.store.finish(job_id, 'done', self.handler(items))
+            except Exception as e:
+                print(f"Error in job {job_id}: {str(e)}")
+                self.store.finish(job_id, 'failed', {'error': str(e)})
+            finally:
+                with self._recovered_lock:
+                    self._running.discard(job_id)
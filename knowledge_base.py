@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from labels import load_disease_info
+from model_store import _file_lock
+
+SCHEMA_VERSION = '1'
+
+# Ordinal ranks so severity and humidity can be range-filtered
+SEVERITY_RANKS = {'low': 1, 'moderate': 2, 'moderate to high': 3, 'high': 4, 'very high': 5}
+HUMIDITY_RANKS = {'low': 1, 'moderate': 2, 'high': 3}
+
+_FAHRENHEIT_RANGE = re.compile(r'(-?\d+(?:\.\d+)?)\s*-\s*(-?\d+(?:\.\d+)?)\s*°?\s*F')
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE diseases (
+    key TEXT PRIMARY KEY,
+    crop TEXT NOT NULL,
+    disease TEXT NOT NULL,
+    healthy INTEGER NOT NULL,
+    severity TEXT,
+    severity_rank INTEGER,
+    humidity TEXT,
+    humidity_rank INTEGER,
+    temp_min_f REAL,
+    temp_max_f REAL,
+    info TEXT NOT NULL
+);
+CREATE INDEX diseases_crop ON diseases (crop COLLATE NOCASE);
+CREATE INDEX diseases_severity ON diseases (severity_rank);
+CREATE INDEX diseases_humidity ON diseases (humidity_rank);
+CREATE INDEX diseases_temperature ON diseases (temp_min_f, temp_max_f);
+CREATE TABLE pesticides (key TEXT NOT NULL, name TEXT NOT NULL COLLATE NOCASE, application TEXT);
+CREATE INDEX pesticides_name ON pesticides (name COLLATE NOCASE, key);
+'''
+TEXT_COLUMNS = ('crop', 'disease', 'causes', 'prevention', 'pesticides', 'weather', 'occurrence')
+FTS_SCHEMA = f"CREATE VIRTUAL TABLE diseases_fts USING fts5(key UNINDEXED, {', '.join(TEXT_COLUMNS)})"
+# Without FTS5 (some SQLite builds, e.g. the one TensorFlow links in, lack it)
+# the same text is kept in a plain table and searched with LIKE
+PLAIN_TEXT_SCHEMA = f"CREATE TABLE diseases_fts (key TEXT PRIMARY KEY, {', '.join(TEXT_COLUMNS)})"
+
+
+def fts5_available():
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute('CREATE VIRTUAL TABLE probe USING fts5(text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def parse_temperature(text):
+    """(min, max) in °F from strings like '60-70°F (15-21°C)', or (None, None)"""
+    match = _FAHRENHEIT_RANGE.search(text or '')
+    if not match:
+        return None, None
+    return float(match.group(1)), float(match.group(2))
+
+
+def _row(key, info):
+    crop, _, disease = key.partition('___')
+    weather = info.get('weather_conditions') or {}
+    severity = info.get('severity_level')
+    humidity = weather.get('humidity')
+    temp_min, temp_max = parse_temperature(weather.get('temperature'))
+    return (key, crop, disease.replace('_', ' '), int(disease == 'healthy'),
+            severity, SEVERITY_RANKS.get((severity or '').lower()),
+            humidity, HUMIDITY_RANKS.get((humidity or '').lower()),
+            temp_min, temp_max, json.dumps(info, ensure_ascii=False))
+
+
+def _fts_row(key, info):
+    crop, _, disease = key.partition('___')
+    weather = info.get('weather_conditions') or {}
+    return (key, crop, disease.replace('_', ' '),
+            ' '.join(info.get('causes') or []),
+            ' '.join(info.get('prevention') or []),
+            ' '.join(f"{p.get('name', '')} {p.get('application', '')}" for p in info.get('pesticides') or []),
+            ' '.join(str(v) for v in weather.values()),
+            info.get('occurrence_pattern') or '')
+
+
+def build(source, db_path):
+    """Index the DISEASE_INFO-shaped `source` file into a fresh SQLite database at `db_path`"""
+    info = load_disease_info(source)
+    tmp = f'{db_path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    fts = fts5_available()
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(SCHEMA)
+        conn.execute(FTS_SCHEMA if fts else PLAIN_TEXT_SCHEMA)
+        conn.executemany('INSERT INTO diseases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [_row(key, entry) for key, entry in info.items()])
+        conn.executemany('INSERT INTO pesticides VALUES (?, ?, ?)',
+                         [(key, p['name'], p.get('application', ''))
+                          for key, entry in info.items() for p in entry.get('pesticides') or [] if p.get('name')])
+        conn.executemany('INSERT INTO diseases_fts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [_fts_row(key, entry) for key, entry in info.items()])
+        conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                         [('schema_version', SCHEMA_VERSION), ('source_sha256', _sha256(source)),
+                          ('fts5', str(int(fts)))])
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, db_path)
+
+
+def _is_current(source, db_path):
+    try:
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return (meta.get('schema_version') == SCHEMA_VERSION and meta.get('source_sha256') == _sha256(source)
+            and meta.get('fts5') == str(int(fts5_available())))
+
+
+class DiseaseKnowledgeBase:
+    """Read-only, indexed view of the disease info catalogue.
+
+    The SQLite database is built once from the source file and rebuilt only
+    when the file's hash changes; concurrent workers starting together wait
+    on a lock rather than each building it. Every thread gets its own
+    read-only connection.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.fts5 = dict(self._conn.execute('SELECT key, value FROM meta')).get('fts5') == '1'
+
+    @classmethod
+    def open(cls, source, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        if not _is_current(source, db_path):
+            with _file_lock(db_path + '.lock'):
+                if not _is_current(source, db_path):
+                    print(f" ** Indexing disease info from {source} **")
+                    build(source, db_path)
+        return cls(db_path)
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def all(self):
+        """Every entry as the key -> info mapping the response path uses"""
+        return {row['key']: json.loads(row['info']) for row in self._conn.execute('SELECT key, info FROM diseases ORDER BY rowid')}
+
+    def search(self, q=None, crop=None, pesticide=None, severity=None, min_severity=None, humidity=None,
+               temperature=None, include_healthy=False, page=1, per_page=20, expand=False):
+        """Diseases matching every given filter, a page at a time.
+
+        `temperature` is a (low, high) range in °F and matches entries whose
+        favoured range overlaps it; `q` is an FTS5 query over all the text
+        (or, without FTS5, words that must all appear somewhere in it).
+        Returns (total, rows) with rows ordered by relevance for `q` and by
+        key otherwise.
+        """
+        where, params, joins = [], [], ''
+        order = 'd.key'
+        if q:
+            joins += ' JOIN diseases_fts f ON f.key = d.key'
+            if self.fts5:
+                where.append('diseases_fts MATCH ?')
+                params.append(q)
+                order = 'f.rank, d.key'
+            else:
+                text = " || ' ' || ".join(f'f.{column}' for column in TEXT_COLUMNS)
+                for word in q.split():
+                    where.append(f'({text}) LIKE ?')
+                    params.append(f'%{word}%')
+        if crop:
+            where.append('d.crop = ? COLLATE NOCASE')
+            params.append(crop)
+        if pesticide:
+            where.append('d.key IN (SELECT key FROM pesticides WHERE name = ? COLLATE NOCASE)')
+            params.append(pesticide)
+        if severity:
+            where.append('d.severity = ? COLLATE NOCASE')
+            params.append(severity)
+        if min_severity:
+            rank = SEVERITY_RANKS.get(min_severity.lower())
+            if rank is None:
+                raise ValueError(f'Unknown severity {min_severity!r}, expected one of {list(SEVERITY_RANKS)}')
+            where.append('d.severity_rank >= ?')
+            params.append(rank)
+        if humidity:
+            rank = HUMIDITY_RANKS.get(humidity.lower())
+            if rank is None:
+                raise ValueError(f'Unknown humidity {humidity!r}, expected one of {list(HUMIDITY_RANKS)}')
+            where.append('d.humidity_rank = ?')
+            params.append(rank)
+        if temperature:
+            where.append('d.temp_min_f <= ? AND d.temp_max_f >= ?')
+            params.extend([temperature[1], temperature[0]])
+        if not include_healthy:
+            where.append('d.healthy = 0')
+
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+        try:
+            total = self._conn.execute(f'SELECT COUNT(*) FROM diseases d{joins}{clause}', params).fetchone()[0]
+            rows = self._conn.execute(
+                f'SELECT d.key, d.crop, d.disease, d.severity, d.humidity, d.temp_min_f, d.temp_max_f, d.info '
+                f'FROM diseases d{joins}{clause} ORDER BY {order} LIMIT ? OFFSET ?',
+                params + [per_page, (page - 1) * per_page]).fetchall()
+        except sqlite3.OperationalError as e:
+            # Malformed FTS5 query syntax
+            raise ValueError(f'Invalid search query: {str(e)}')
+
+        results = []
+        for row in rows:
+            result = {'key': row['key'], 'crop': row['crop'], 'disease': row['disease'],
+                      'severity_level': row['severity'], 'humidity': row['humidity'],
+                      'temperature_f': [row['temp_min_f'], row['temp_max_f']] if row['temp_min_f'] is not None else None}
+            if expand:
+                result['disease_info'] = json.loads(row['info'])
+            results.append(result)
+        return total, results
+
+    def pesticides(self):
+        """Every pesticide name with the number of diseases it treats"""
+        return [{'name': row[0], 'diseases': row[1]} for row in self._conn.execute(
+            'SELECT name, COUNT(DISTINCT key) FROM pesticides GROUP BY name COLLATE NOCASE ORDER BY name')]
@@ -0,0 +1,135 @@
+import json
+from urllib.parse import quote
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Output classes of the model, in the order of its softmax units
+CLASS_NAMES = [
+    'Apple___Apple_scab',
+    'Apple___Black_rot',
+    'Apple___Cedar_apple_rust',
+    'Apple___healthy',
+    'Blueberry___healthy',
+    'Cherry_(including_sour)___Powdery_mildew',
+    'Cherry_(including_sour)___healthy',
+    'Corn_(maize)___Cercospora_leaf_spot Gray_leaf_spot',
+    'Corn_(maize)___Common_rust_',
+    'Corn_(maize)___Northern_Leaf_Blight',
+    'Corn_(maize)___healthy',
+    'Grape___Black_rot',
+    'Grape___Esca_(Black_Measles)',
+    'Grape___Leaf_blight_(Isariopsis_Leaf_Spot)',
+    'Grape___healthy',
+    'Orange___Haunglongbing_(Citrus_greening)',
+    'Peach___Bacterial_spot',
+    'Peach___healthy',
+    'Pepper,_bell___Bacterial_spot',
+    'Pepper,_bell___healthy',
+    'Potato___Early_blight',
+    'Potato___Late_blight',
+    'Potato___healthy',
+    'Raspberry___healthy',
+    'Soybean___healthy',
+    'Squash___Powdery_mildew',
+    'Strawberry___Leaf_scorch',
+    'Strawberry___healthy',
+    'Tomato___Bacterial_spot',
+    'Tomato___Early_blight',
+    'Tomato___Late_blight',
+    'Tomato___Leaf_Mold',
+    'Tomato___Septoria_leaf_spot',
+    'Tomato___Spider_mites Two-spotted_spider_mite',
+    'Tomato___Target_Spot',
+    'Tomato___Tomato_Yellow_Leaf_Curl_Virus',
+    'Tomato___Tomato_mosaic_virus',
+    'Tomato___healthy',
+]
+
+
+def load_disease_info(path):
+    """Read a DISEASE_INFO-shaped mapping from a .json or .yaml/.yml file"""
+    with open(path, encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise RuntimeError('PyYAML is required to load a YAML disease info file')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+class LabelIndex:
+    """Everything the response path needs per class, built once at startup.
+
+    Crop and disease display names, the disease info entry and the JSON for
+    the static part of the response are all computed here, so answering a
+    request is an index lookup plus byte concatenation.
+    """
+
+    def __init__(self, class_names, info_for):
+        self.keys = tuple(class_names)
+        self.crops = tuple(k.split('___')[0] for k in self.keys)
+        self.diseases = tuple(k.split('___')[1].replace('_', ' ') for k in self.keys)
+        self.infos = tuple(info_for(k) for k in self.keys)
+        # '"crop": ..., "disease": ..., "disease_info": {...}' without the braces
+        self._fragments = tuple(
+            json.dumps({'crop': c, 'disease': d, 'disease_info': i})[1:-1].encode()
+            for c, d, i in zip(self.crops, self.diseases, self.infos))
+        self._compact_fragments = tuple(
+            json.dumps({'class_index': n, 'class': k, 'crop': c, 'disease': d,
+                        'disease_info_url': f'/diseases/{quote(k)}'})[1:-1].encode()
+            for n, (k, c, d) in enumerate(zip(self.keys, self.crops, self.diseases)))
+        self._top_k_prefixes = tuple(
+            json.dumps({'class_index': n, 'crop': c, 'disease': d})[:-1].encode() + b', "probability": '
+            for n, (c, d) in enumerate(zip(self.crops, self.diseases)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def verify(self, num_outputs):
+        if num_outputs != len(self.keys):
+            raise ValueError(f'Model has {num_outputs} outputs but {len(self.keys)} class labels are defined')
+
+    def top_k_entry(self, i, probability):
+        return {'class_index': int(i), 'crop': self.crops[i], 'disease': self.diseases[i],
+                'probability': float(probability)}
+
+    def as_dict(self, p, idx, uncertain):
+        i = idx[0]
+        return {
+            'crop': self.crops[i],
+            'disease': self.diseases[i],
+            'disease_info': self.infos[i],
+            'confidence': float(p[i]),
+            'uncertain': uncertain,
+            'top_k': [self.top_k_entry(j, p[j]) for j in idx],
+        }
+
+    def as_compact_dict(self, p, idx, uncertain):
+        """Just the class and confidence; disease info lives at /diseases/<class>"""
+        i = idx[0]
+        return {
+            'class_index': int(i),
+            'class': self.keys[i],
+            'crop': self.crops[i],
+            'disease': self.diseases[i],
+            'disease_info_url': f'/diseases/{quote(self.keys[i])}',
+            'confidence': float(p[i]),
+            'uncertain': uncertain,
+        }
+
+    def render_compact(self, p, idx, uncertain):
+        i = idx[0]
+        return b''.join((b'{', self._compact_fragments[i],
+                          b', "confidence": ', repr(float(p[i])).encode(),
+                          b', "uncertain": ', b'true' if uncertain else b'false', b'}'))
+
+    def render(self, p, idx, uncertain):
+        """The as_dict() response serialized straight to JSON bytes"""
+        i = idx[0]
+        top = b', '.join(self._top_k_prefixes[j] + repr(float(p[j])).encode() + b'}' for j in idx)
+        return b''.join((b'{', self._fragments[i],
+                         b', "confidence": ', repr(float(p[i])).encode(),
+                         b', "uncertain": ', b'true' if uncertain else b'false',
+                         b', "top_k": [', top, b']}'))
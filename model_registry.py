@@ -0,0 +1,151 @@
+import random
+import threading
+import time
+
+from batching import BatchScheduler
+from cache import file_fingerprint
+from model_store import sha256_file
+
+
+class ModelVersion:
+    """A loaded and warmed-up model: its backend plus the predictor requests use"""
+
+    def __init__(self, name, backend, predictor):
+        self.name = name
+        self.backend = backend
+        self.predictor = predictor
+        self.fingerprint = file_fingerprint(backend.path)
+        self.loaded_at = time.time()
+        self._sha256 = None
+
+    @property
+    def path(self):
+        return self.backend.path
+
+    @property
+    def num_classes(self):
+        return self.backend.num_classes
+
+    def sha256(self):
+        """Content hash of the model file, computed on the first call"""
+        if self._sha256 is None:
+            self._sha256 = sha256_file(self.path)
+        return self._sha256
+
+    def close(self):
+        if isinstance(self.predictor, BatchScheduler):
+            self.predictor.close()
+
+    def describe(self):
+        return {'version': self.name, 'path': self.path, 'fingerprint': self.fingerprint, 'loaded_at': self.loaded_at}
+
+
+class ModelRegistry:
+    """The active model version plus an optional candidate, swapped without restarts.
+
+    `loader(name, path)` fetches (or, given a local `path`, just opens),
+    loads and warms up a version and returns a ModelVersion; `load` runs it on a background thread so the current
+    version keeps serving meanwhile. Swapping is a single reference
+    assignment, so a request sees either the old or the new version, never
+    a half-loaded one. A candidate either takes `percent` of the traffic
+    (canary) or, in shadow mode, runs alongside the active version without
+    affecting responses. `on_activate(version)` is called after every swap.
+    """
+
+    MODES = ('activate', 'canary', 'shadow')
+
+    def __init__(self, loader, on_activate=None):
+        self.loader = loader
+        self.on_activate = on_activate
+        self.active = None
+        self.candidate = None
+        self.percent = 0.0
+        self.shadow = False
+        self._lock = threading.Lock()
+        self._loads = {}
+
+    def activate(self, version):
+        with self._lock:
+            previous, self.active = self.active, version
+            if self.candidate is version:
+                self.candidate = None
+        if self.on_activate is not None:
+            self.on_activate(version)
+        if previous is not None and previous is not version:
+            previous.close()
+        print(f" ** Model version {version.name} active **")
+
+    def set_candidate(self, version, percent=0.0, shadow=False):
+        with self._lock:
+            previous, self.candidate = self.candidate, version
+            self.percent = percent
+            self.shadow = shadow
+        if previous is not None and previous is not version:
+            previous.close()
+        print(f" ** Model version {version.name} is the {'shadow' if shadow else f'{percent:g}% canary'} candidate **")
+
+    def promote(self):
+        candidate = self.candidate
+        if candidate is None:
+            raise LookupError('No candidate version to promote')
+        self.activate(candidate)
+        return candidate
+
+    def drop_candidate(self):
+        with self._lock:
+            candidate, self.candidate = self.candidate, None
+        if candidate is None:
+            raise LookupError('No candidate version loaded')
+        candidate.close()
+        return candidate
+
+    def route(self):
+        """(version to answer with, version to shadow-run or None) for one request"""
+        active, candidate = self.active, self.candidate
+        if candidate is None:
+            return active, None
+        if self.shadow:
+            return active, candidate
+        if random.random() * 100.0 < self.percent:
+            return candidate, None
+        return active, None
+
+    def load(self, name, mode='activate', percent=0.0, path=None):
+        """Load `name` (from the local file `path` if given) in the background,
+        then activate it or make it the candidate"""
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown mode {mode!r}, expected one of {self.MODES}')
+        with self._lock:
+            if self._loads.get(name, {}).get('state') == 'loading':
+                raise RuntimeError(f'Version {name} is already loading')
+            self._loads[name] = {'state': 'loading', 'mode': mode, 'started': time.time()}
+        threading.Thread(target=self._load, args=(name, mode, percent, path), name=f'model-load-{name}', daemon=True).start()
+
+    def _load(self, name, mode, percent, path):
+        started = time.perf_counter()
+        try:
+            version = self.loader(name, path)
+        except Exception as e:
+            print(f"Error loading model version {name}: {str(e)}")
+            with self._lock:
+                self._loads[name].update(state='failed', error=str(e))
+            return
+        if mode == 'activate':
+            self.activate(version)
+        else:
+            self.set_candidate(version, percent, shadow=mode == 'shadow')
+        with self._lock:
+            self._loads[name].update(state='loaded', seconds=time.perf_counter() - started)
+
+    def status(self):
+        with self._lock:
+            active, candidate = self.active, self.candidate
+            status = {
+                'active': active.describe() if active is not None else None,
+                'candidate': None,
+                'loads': {name: dict(load) for name, load in self._loads.items()},
+            }
+            if candidate is not None:
+                status['candidate'] = dict(candidate.describe(), mode='shadow' if self.shadow else 'canary',
+                                           percent=None if self.shadow else self.percent)
+        return status
@@ -0,0 +1,136 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+
+import gdown
+
+
+class ModelStoreError(Exception):
+    pass
+
+
+# Model versions are Google Drive file ids, and they name files in the cache
+VERSION_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def check_version(version):
+    """Return `version` if it is a well-formed Google Drive file id, else raise ValueError"""
+    if not isinstance(version, str) or not VERSION_PATTERN.fullmatch(version):
+        raise ValueError(f'Invalid model version {version!r}: expected a Google Drive file id')
+    return version
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def _file_lock(path):
+    """Exclusive lock so concurrent workers don't download the same model in parallel"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ModelStore:
+    """Local cache of model artifacts with a SHA-256 manifest.
+
+    manifest.json in the cache directory maps each model version (the Google
+    Drive file id) to its file name, SHA-256 and the size/mtime at which it
+    was last verified, so a warm start only has to stat the file.
+    """
+
+    def __init__(self, cache_dir, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'versions': {}}
+
+    def _write_manifest(self, manifest):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def _set_manifest_entry(self, version, entry):
+        # Versions are downloaded under their own locks, so concurrent
+        # downloads of different versions take this one to update the
+        # shared manifest without dropping each other's entries
+        with _file_lock(os.path.join(self.cache_dir, 'manifest.lock')):
+            manifest = self._read_manifest()
+            manifest['versions'][version] = entry
+            self._write_manifest(manifest)
+
+    def _is_valid(self, path, entry, expected_sha256):
+        if not os.path.exists(path) or entry is None:
+            return False
+        if expected_sha256 and entry.get('sha256') != expected_sha256:
+            return False
+        st = os.stat(path)
+        if entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+            return True
+        # File was touched since we last verified it: re-hash before trusting it
+        return sha256_file(path) == entry.get('sha256')
+
+    def ensure(self, version, filename='plant_disease_model.h5', expected_sha256=None):
+        """Return a local path for `version`, downloading it only if missing or stale"""
+        check_version(version)
+        path = os.path.join(self.cache_dir, f'{version}_{filename}')
+        if self._is_valid(path, self._read_manifest()['versions'].get(version), expected_sha256):
+            return path
+
+        with _file_lock(os.path.join(self.cache_dir, f'{version}.lock')):
+            # Another worker may have finished the download while we waited
+            manifest = self._read_manifest()
+            if self._is_valid(path, manifest['versions'].get(version), expected_sha256):
+                return path
+            if self.offline:
+                raise ModelStoreError(f'Model {version} is not in the local cache and offline mode is on')
+
+            # A worker killed mid-download (e.g. by gunicorn's timeout) leaves
+            # its partial file behind; nobody else can be writing one for this
+            # version while we hold its lock
+            for stale in glob.glob(os.path.join(self.cache_dir, f'{glob.escape(version)}.*.part')):
+                os.remove(stale)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f'{version}.', suffix='.part')
+            os.close(fd)
+            try:
+                url = f'https://drive.google.com/uc?id={version}'
+                if gdown.download(url, tmp, quiet=False) is None:
+                    raise ModelStoreError(f'Download of model {version} failed')
+                digest = sha256_file(tmp)
+                if expected_sha256 and digest != expected_sha256:
+                    raise ModelStoreError(f'Checksum mismatch for model {version}: got {digest}')
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+            st = os.stat(path)
+            self._set_manifest_entry(version, {
+                'filename': os.path.basename(path),
+                'sha256': digest,
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+            })
+            return path
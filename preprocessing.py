@@ -0,0 +1,133 @@
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+IMG_SIZE = 224
+
+# Decoded pixels are scaled into the float32 output in a single pass
+_SCALE = np.float32(1.0 / 255.0)
+
+
+def load_rgb(src, size=IMG_SIZE):
+    """Decode an image (path or file-like object) to a size x size RGB PIL image.
+
+    JPEGs much larger than the target are decoded at a reduced DCT scale
+    (PIL's draft mode), so a 12MP phone photo never gets fully decoded.
+    Resizing uses nearest-neighbour like keras' load_img did.
+    """
+    img = Image.open(src)
+    if img.format == 'JPEG' and min(img.size) >= 2 * size:
+        img.draft('RGB', (size, size))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (size, size):
+        img = img.resize((size, size), Image.NEAREST)
+    return img
+
+
+def preprocess_into(src, out, timings=None):
+    """Decode `src` straight into `out`, a preallocated (224, 224, 3) float32 slot.
+
+    If a `timings` dict is given, the decode+resize and scaling durations are
+    recorded in it (seconds) under 'decode' and 'preprocess'.
+    """
+    start = time.perf_counter()
+    img = load_rgb(src, out.shape[0])
+    decoded = time.perf_counter()
+    np.multiply(np.asarray(img), _SCALE, out=out)
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['preprocess'] = time.perf_counter() - decoded
+    return out
+
+
+def preprocess_image(img_path, timings=None):
+    """Load an image (path or file-like object) into a 1x224x224x3 tensor"""
+    x = np.empty((1, IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    preprocess_into(img_path, x[0], timings)
+    return x
+
+
+def preprocess_bytes(data):
+    timings = {}
+    return preprocess_image(io.BytesIO(data), timings), timings
+
+
+def _decode_into(data, out):
+    try:
+        preprocess_into(io.BytesIO(data), out)
+        return None
+    except Exception as e:
+        return f'Failed to decode image: {str(e)}'
+
+
+def _decode(data):
+    try:
+        return preprocess_bytes(data)[0], None
+    except Exception as e:
+        return None, f'Failed to decode image: {str(e)}'
+
+
+class DecodePool:
+    """Decode/resize stage that runs off the request threads.
+
+    kind='thread' relies on PIL releasing the GIL while decoding and
+    resizing, and lets workers write straight into a shared batch array.
+    kind='process' sidesteps the GIL entirely at the cost of pickling each
+    224x224 tensor back to the parent. Its workers are forked when the
+    pool is created, so create it before any model is loaded.
+    """
+
+    def __init__(self, workers=4, kind='thread'):
+        self.kind = kind
+        if kind == 'process':
+            # Fork: the workers only run PIL/numpy and must not re-import the app.
+            # The executor would fork them lazily on the first submit, by which
+            # time TensorFlow has loaded a model and started its thread pools,
+            # which a forked child does not survive; fork them all now instead.
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+            self._executor.submit(int).result()
+        elif kind == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode')
+        else:
+            raise ValueError(f'Unknown decode pool kind {kind!r}')
+
+    def submit(self, data):
+        """Start decoding raw image bytes; the future resolves to (tensor, timings)"""
+        return self._executor.submit(preprocess_bytes, data)
+
+    def decode(self, data, timings=None):
+        """Raw image bytes -> (1, 224, 224, 3) tensor; raises if the image is unreadable"""
+        x, stage_timings = self.submit(data).result()
+        if timings is not None:
+            timings.update(stage_timings)
+        return x
+
+    def decode_batch(self, datas, size=IMG_SIZE):
+        """Decode many images into one (n, size, size, 3) array plus a per-row error list"""
+        batch = np.empty((len(datas), size, size, 3), dtype=np.float32)
+        if self.kind == 'thread':
+            return batch, list(self._executor.map(_decode_into, datas, batch))
+        errors = []
+        for i, (x, error) in enumerate(self._executor.map(_decode, datas)):
+            if x is not None:
+                batch[i] = x[0]
+            errors.append(error)
+        return batch, errors
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp')
+
+
+def iter_image_files(directory):
+    """Every image file under `directory`, in a stable order"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
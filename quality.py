@@ -0,0 +1,46 @@
+import numpy as np
+
+class ImageRejected(Exception):
+    """Raised when an upload fails the quality pre-check"""
+
+    def __init__(self, reason):
+        super().__init__(f'Image rejected: {reason.replace("_", " ")}')
+        self.reason = reason
+
+
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def leaf_mask(pixels, min_saturation=0.08):
+    """Pixels (last axis RGB in [0, 1]) that look like leaf tissue: saturated,
+    with the blue channel lowest. That covers green, yellow and brown leaves
+    but not sky, soil greys or paper."""
+    hi = pixels.max(axis=-1)
+    lo = pixels.min(axis=-1)
+    return ((hi - lo) > min_saturation) & (pixels[..., 2] <= lo)
+
+
+def check_quality(x, blur_threshold=0.0004, dark_threshold=0.08, bright_threshold=0.92, min_leaf_fraction=0.1):
+    """Cheap checks on a preprocessed (1, 224, 224, 3) tensor before spending a
+    forward pass on it. Returns a rejection reason, or None if the image is usable.
+
+    Everything runs on a 56x56 strided view: exposure from mean luminance, blur
+    from the variance of a 4-neighbour Laplacian, and "is there a leaf at all"
+    from the share of pixels that pass `leaf_mask`.
+    """
+    small = x[0, ::4, ::4]
+    gray = small @ _LUMA
+
+    brightness = gray.mean()
+    if brightness < dark_threshold:
+        return 'underexposed'
+    if brightness > bright_threshold:
+        return 'overexposed'
+
+    lap = (4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:])
+    if lap.var() < blur_threshold:
+        return 'blurry'
+
+    if leaf_mask(small).mean() < min_leaf_fraction:
+        return 'no_leaf_detected'
+    return None
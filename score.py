@@ -0,0 +1,244 @@
+"""Score large collections of images offline with the serving model.
+
+    python score.py survey_tiles/ --h5 model.h5 --output results.jsonl
+    python score.py tiles.tar.gz --h5 model.h5 --output results.csv --batch-size 128
+    python score.py manifest.csv --h5 model.h5 --output results.parquet --backend tflite-dynamic
+    python score.py survey_tiles/ --h5 model.h5 --output results.csv --calibration calibration.json
+
+Inputs are streamed (a directory tree, a zip/tar archive or a CSV manifest
+with a 'path' column), decoded ahead of inference on the decode pool and
+written out batch by batch. After every batch the number of inputs done and
+the size of the output are checkpointed next to it, so rerunning the same
+command after a crash cuts off anything written after the last checkpoint
+(a repeated batch or a half-written line) and resumes from there instead of
+starting over.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import queue
+import sys
+import tarfile
+import threading
+import zipfile
+
+import numpy as np
+
+from backends import BACKENDS, load_backend
+from confidence import calibrate, load_temperature
+from labels import CLASS_NAMES
+from preprocessing import IMAGE_EXTENSIONS, DecodePool, iter_image_files
+
+FIELDS = ['source', 'crop', 'disease', 'class_index', 'confidence', 'error']
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def iter_inputs(source):
+    """Yield (name, read) pairs where read() returns the image bytes"""
+    if os.path.isdir(source):
+        for path in iter_image_files(source):
+            yield path, lambda path=path: _read_file(path)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield info.filename, lambda info=info: zf.read(info)
+    elif tarfile.is_tarfile(source):
+        # Stream mode: members are read in order without seeking back
+        with tarfile.open(source, mode='r|*') as tf:
+            for member in tf:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    data = tf.extractfile(member).read()
+                    yield member.name, lambda data=data: data
+    elif source.lower().endswith('.csv'):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            for row in csv.DictReader(f):
+                path = os.path.join(base, row['path'])
+                yield row['path'], lambda path=path: _read_file(path)
+    else:
+        raise SystemExit(f'Unsupported input {source!r}: expected a directory, zip/tar archive or .csv manifest')
+
+
+def _prefetch(batches, decode_pool, depth):
+    """Read and decode upcoming batches on a background thread while the model runs"""
+    out = queue.Queue(maxsize=depth)
+
+    def produce():
+        try:
+            for chunk in batches:
+                names, datas, errors = [], [], {}
+                for i, (name, read) in enumerate(chunk):
+                    names.append(name)
+                    try:
+                        datas.append(read())
+                    except Exception as e:
+                        datas.append(b'')
+                        errors[i] = f'Failed to read image: {str(e)}'
+                x, decode_errors = decode_pool.decode_batch(datas)
+                out.put((names, x, [errors.get(i, e) for i, e in enumerate(decode_errors)]))
+        except BaseException as e:
+            out.put(e)
+            return
+        out.put(None)
+
+    threading.Thread(target=produce, name='score-prefetch', daemon=True).start()
+    while True:
+        item = out.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class _Writer:
+    """Append-only CSV / JSONL / Parquet output that survives restarts.
+
+    `resume` is the `position()` recorded at the last checkpoint (None to
+    start afresh); output past it is from a batch that was never
+    checkpointed and is discarded.
+    """
+
+    def __init__(self, path, resume=None):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower().lstrip('.')
+        if self.format not in ('csv', 'jsonl', 'parquet'):
+            raise SystemExit('Output must end in .csv, .jsonl or .parquet')
+        if self.format == 'parquet':
+            # One part file per batch inside a dataset directory
+            os.makedirs(path, exist_ok=True)
+            self._parts = resume or 0
+            for p in os.listdir(path):
+                if p.endswith('.parquet') and not (p.startswith('part-') and int(p[5:-8]) < self._parts):
+                    os.remove(os.path.join(path, p))
+        else:
+            new = not (resume is not None and os.path.exists(path))
+            if not new:
+                os.truncate(path, resume)
+            self._file = open(path, 'a' if not new else 'w', newline='')
+            if self.format == 'csv':
+                self._csv = csv.DictWriter(self._file, fieldnames=FIELDS)
+                if new:
+                    self._csv.writeheader()
+
+    def write(self, rows):
+        if self.format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pylist(rows)
+            pq.write_table(table, os.path.join(self.path, f'part-{self._parts:06d}.parquet'))
+            self._parts += 1
+            return
+        if self.format == 'csv':
+            self._csv.writerows(rows)
+        else:
+            self._file.writelines(json.dumps(row) + '\n' for row in rows)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def position(self):
+        """Parquet parts or output bytes written so far, to checkpoint"""
+        if self.format == 'parquet':
+            return self._parts
+        return os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        if self.format != 'parquet':
+            self._file.close()
+
+
+def _read_checkpoint(path):
+    """(inputs done, output position) from the last checkpoint, or (0, None)"""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+        return checkpoint['done'], checkpoint['position']
+    except (OSError, ValueError, KeyError):
+        return 0, None
+
+
+def _write_checkpoint(path, done, position):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'done': done, 'position': position}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _rows(names, preds, errors):
+    rows = []
+    for i, name in enumerate(names):
+        row = dict.fromkeys(FIELDS)
+        row['source'] = name
+        if errors[i] is not None:
+            row['error'] = errors[i]
+        else:
+            idx = int(np.argmax(preds[i]))
+            crop, disease = CLASS_NAMES[idx].split('___')
+            row.update(crop=crop, disease=disease.replace('_', ' '), class_index=idx,
+                       confidence=float(preds[i][idx]))
+        rows.append(row)
+    return rows
+
+
+def score(source, h5_path, output, backend='keras', batch_size=64, decode_workers=4, prefetch=2, restart=False,
+          calibration_file=None):
+    """Score every input of `source` into `output`; confidences are
+    temperature-scaled by `calibration_file` like the service's"""
+    temperature = load_temperature(calibration_file)
+    checkpoint = output + '.checkpoint'
+    done, position = (0, None) if restart else _read_checkpoint(checkpoint)
+    if done:
+        print(f" ** Resuming after {done} inputs **")
+
+    model = load_backend(backend, h5_path, batch_sizes=(batch_size,))
+    decode_pool = DecodePool(decode_workers)
+    writer = _Writer(output, resume=position if done else None)
+
+    inputs = itertools.islice(iter_inputs(source), done, None)
+    batches = iter(lambda: list(itertools.islice(inputs, batch_size)), [])
+    try:
+        for names, x, errors in _prefetch(batches, decode_pool, prefetch):
+            ok = [i for i, e in enumerate(errors) if e is None]
+            preds = np.zeros((len(names), len(CLASS_NAMES)), dtype=np.float32)
+            if ok:
+                preds[ok] = calibrate(np.asarray(model.predict(x if len(ok) == len(names) else x[ok]),
+                                                 dtype=np.float64), temperature)
+            writer.write(_rows(names, preds, errors))
+            done += len(names)
+            _write_checkpoint(checkpoint, done, writer.position())
+            print(f" ** Scored {done} images **")
+    finally:
+        writer.close()
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('source', help='Directory, zip/tar archive or CSV manifest with a path column')
+    parser.add_argument('--h5', required=True, help='Path to the .h5 model (converted backends sit next to it)')
+    parser.add_argument('--output', required=True, help='Results file: .csv, .jsonl or .parquet')
+    parser.add_argument('--backend', choices=list(BACKENDS), default='keras')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--prefetch', type=int, default=2, help='Decoded batches to keep ready ahead of the model')
+    parser.add_argument('--restart', action='store_true', help='Ignore any checkpoint and score from the start')
+    parser.add_argument('--calibration', default=os.environ.get('CALIBRATION_FILE', ''),
+                        help='Temperature-scaling JSON the service uses (default: $CALIBRATION_FILE)')
+    args = parser.parse_args(argv)
+
+    score(args.source, args.h5, args.output, args.backend, args.batch_size,
+          args.decode_workers, args.prefetch, args.restart, args.calibration)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Sliding-window inference for large field and drone photos.
+
+Squashing a whole-plant or survey image to 224x224 throws away the detail
+the model needs. Instead the image is decoded once, resized so a grid of
+overlapping 224x224 tiles covers it exactly, and the tiles are taken as
+strided views over that one array. A vectorized leaf-pixel test on a
+subsample of every tile drops background (soil, sky) tiles, and only the
+remaining ones are gathered into the batch for a single forward pass.
+"""
+import math
+
+import numpy as np
+from PIL import Image
+from numpy.lib.stride_tricks import sliding_window_view
+
+from preprocessing import IMG_SIZE
+from quality import leaf_mask
+
+_SCALE = np.float32(1.0 / 255.0)
+
+
+class TileGrid:
+    """Geometry of a tiling: `rows` x `cols` tiles of `size` pixels, `stride` apart,
+    over the image resized to `width` x `height` (a `scale` of the original)"""
+
+    def __init__(self, rows, cols, size, stride, width, height, scale):
+        self.rows = rows
+        self.cols = cols
+        self.size = size
+        self.stride = stride
+        self.width = width
+        self.height = height
+        self.scale = scale
+
+    @classmethod
+    def fit(cls, width, height, size=IMG_SIZE, overlap=0.25, max_tiles=256):
+        """The grid for a `width` x `height` image, scaled down until it has at most `max_tiles` tiles"""
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be at least 0 and below 1')
+        if max_tiles < 1:
+            # No grid has fewer than one tile; scaling down would never stop
+            raise ValueError('max_tiles must be at least 1')
+        stride = max(1, int(round(size * (1 - overlap))))
+        scale = 1.0
+        while True:
+            w, h = width * scale, height * scale
+            cols = max(1, math.ceil((w - size) / stride) + 1)
+            rows = max(1, math.ceil((h - size) / stride) + 1)
+            if rows * cols <= max_tiles:
+                break
+            scale *= min(0.95, math.sqrt(max_tiles / (rows * cols)))
+        return cls(rows, cols, size, stride, size + (cols - 1) * stride, size + (rows - 1) * stride, scale)
+
+    def describe(self):
+        return {'rows': self.rows, 'cols': self.cols, 'size': self.size, 'stride': self.stride,
+                'width': self.width, 'height': self.height, 'scale': round(self.scale, 4)}
+
+
+def decode_tiled(src, overlap=0.25, max_tiles=256, size=IMG_SIZE):
+    """Decode an image once into a float32 array sized to its tile grid.
+
+    Returns (image, grid). The image is resized by at most a stride's worth
+    of pixels per side beyond the grid's scale so the tiles cover it
+    exactly; large JPEGs are decoded at a reduced DCT scale when that is
+    still at least the target size.
+    """
+    img = Image.open(src)
+    grid = TileGrid.fit(img.size[0], img.size[1], size, overlap, max_tiles)
+    if img.format == 'JPEG':
+        img.draft('RGB', (grid.width, grid.height))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (grid.width, grid.height):
+        img = img.resize((grid.width, grid.height), Image.BILINEAR)
+    return np.multiply(np.asarray(img), _SCALE, dtype=np.float32), grid
+
+
+def tile_views(image, grid):
+    """(rows, cols, size, size, 3) view of the overlapping tiles; nothing is copied"""
+    windows = sliding_window_view(image, (grid.size, grid.size, 3))
+    return windows[::grid.stride, ::grid.stride, 0]
+
+
+def leaf_fractions(tiles, step=8):
+    """Share of leaf-like pixels per tile, from every `step`th pixel of each, as a (rows, cols) array"""
+    return leaf_mask(tiles[:, :, ::step, ::step]).mean(axis=(2, 3))
+
+
+def select_tiles(tiles, min_leaf_fraction=0.15):
+    """Gather the tiles worth running into one contiguous (n, size, size, 3) batch.
+
+    Returns (batch, rows, cols) with the grid position of every batch row.
+    """
+    rows, cols = np.nonzero(leaf_fractions(tiles) >= min_leaf_fraction)
+    return tiles[rows, cols], rows, cols
+
+
+def summarize(probs, rows, cols, grid, disease_classes, min_disease_coverage=0.05):
+    """Aggregate per-tile softmax rows into coverage, a heatmap and one diagnosis.
+
+    `disease_classes` is a boolean mask of the classes that are diseases
+    rather than healthy tissue. The diagnosis is the disease covering the
+    most tiles if it covers at least `min_disease_coverage` of them,
+    otherwise the class covering the most tiles. Returns a dict with the
+    class index `diagnosis`, its share of tiles `coverage`, its mean
+    probability over those tiles `confidence`, the mean probability of
+    every class over all tiles `mean`, per-class `coverage_by_class`, and
+    `heatmap_class`/`heatmap_confidence` grids (-1 and 0 for skipped tiles).
+    """
+    top = probs.argmax(axis=1)
+    confidence = probs[np.arange(len(probs)), top]
+    coverage = np.bincount(top, minlength=probs.shape[1]) / len(probs)
+
+    diseased = np.where(disease_classes, coverage, 0.0)
+    chosen = int(diseased.argmax())
+    if diseased[chosen] < min_disease_coverage:
+        chosen = int(coverage.argmax())
+
+    heatmap_class = np.full((grid.rows, grid.cols), -1, dtype=np.int64)
+    heatmap_confidence = np.zeros((grid.rows, grid.cols), dtype=np.float64)
+    heatmap_class[rows, cols] = top
+    heatmap_confidence[rows, cols] = confidence
+    return {
+        'diagnosis': chosen,
+        'coverage': float(coverage[chosen]),
+        'confidence': float(confidence[top == chosen].mean()),
+        'mean': probs.mean(axis=0),
+        'coverage_by_class': coverage,
+        'heatmap_class': heatmap_class,
+        'heatmap_confidence': heatmap_confidence,
+    }
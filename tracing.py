@@ -0,0 +1,290 @@
+"""Lightweight request tracing with OpenTelemetry-compatible spans.
+
+Spans are always recorded (a handful of small objects per request) but only
+exported for traces that are head-sampled, slow or failed, so keeping
+tracing on costs next to nothing at full load. Export happens on a
+background thread; when the export queue is full, spans are dropped rather
+than slowing requests down.
+"""
+import contextvars
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+import urllib.request
+from contextlib import contextmanager
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_id(nbytes):
+    return '%0*x' % (nbytes * 2, random.getrandbits(nbytes * 8))
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'events', 'status')
+
+    def __init__(self, trace, name, parent_id=None, start_ns=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = 'UNSET'
+
+    @property
+    def trace_id(self):
+        return self.trace.trace_id
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exc):
+        self.status = 'ERROR'
+        self.trace.error = True
+        self.events.append({
+            'name': 'exception',
+            'time_unix_nano': time.time_ns(),
+            'attributes': {
+                'exception.type': type(exc).__name__,
+                'exception.message': str(exc),
+                'exception.stacktrace': ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__)),
+            },
+        })
+
+    def add_stages(self, stages):
+        """Record back-to-back child spans measured elsewhere (e.g. on a pool
+        thread) from their (name, seconds) durations, the last one ending now"""
+        end_ns = time.time_ns()
+        for name, seconds in reversed(stages):
+            child = Span(self.trace, name, self.span_id, end_ns - int(seconds * 1e9))
+            child.end_ns = end_ns
+            self.trace.spans.append(child)
+            end_ns = child.start_ns
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_id,
+            'name': self.name,
+            'start_time_unix_nano': self.start_ns,
+            'end_time_unix_nano': self.end_ns,
+            'attributes': self.attributes,
+            'events': self.events,
+            'status': self.status,
+        }
+
+
+class _Trace:
+    __slots__ = ('trace_id', 'sampled', 'spans', 'error')
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.error = False
+
+
+class Tracer:
+    """Creates spans and decides which finished traces get exported.
+
+    A trace is exported when it was head-sampled (`sample_ratio`, or the
+    sampled flag of an incoming W3C traceparent), when its root span took
+    longer than `slow_ms`, or when any span recorded an exception.
+    Exceptions of the `expected` types (e.g. client errors) are noted on the
+    span as an attribute without failing it.
+    """
+
+    def __init__(self, exporter=None, sample_ratio=0.01, slow_ms=None, expected=()):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.slow_ms = slow_ms
+        self.expected = tuple(expected)
+
+    def _record(self, span, exc):
+        if isinstance(exc, self.expected):
+            span.set_attribute('exception.type', type(exc).__name__)
+        else:
+            span.record_exception(exc)
+
+    @contextmanager
+    def start_trace(self, name, traceparent=None, **attributes):
+        trace_id, parent_id, sampled = None, None, None
+        if traceparent:
+            parts = traceparent.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16 and len(parts[3]) == 2:
+                try:
+                    # Only the lowest trace-flags bit means sampled; others may be set
+                    sampled = bool(int(parts[3], 16) & 1)
+                    trace_id, parent_id = parts[1], parts[2]
+                except ValueError:
+                    sampled = None
+        if sampled is None:
+            sampled = random.random() < self.sample_ratio
+        trace = _Trace(trace_id or _new_id(16), sampled)
+        root = Span(trace, name, parent_id, attributes=attributes)
+        trace.spans.append(root)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            self._record(root, e)
+            raise
+        finally:
+            root.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self._finish(trace, root)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace, name, parent.span_id, attributes=attributes)
+        parent.trace.spans.append(span)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self._record(span, e)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+
+    def _finish(self, trace, root):
+        if self.exporter is None:
+            return
+        slow = self.slow_ms is not None and (root.end_ns - root.start_ns) / 1e6 >= self.slow_ms
+        if trace.sampled or slow or trace.error:
+            root.set_attribute('trace.export_reason', 'sampled' if trace.sampled else 'slow' if slow else 'error')
+            self.exporter.submit([s.to_dict() for s in trace.spans])
+
+
+def current_span():
+    return _current_span.get()
+
+
+def record_exception(exc):
+    """Mark the current span as failed, which also forces its trace to be exported"""
+    span = _current_span.get()
+    if span is not None:
+        span.record_exception(exc)
+
+
+class _BackgroundExporter:
+    """Hands finished traces to a background thread so requests never wait on I/O"""
+
+    def __init__(self, max_queue=10000, flush_interval=1.0):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        threading.Thread(target=self._run, name=f'{type(self).__name__}', daemon=True).start()
+
+    def submit(self, spans):
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += len(spans)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while time.monotonic() < deadline:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.export([span for spans in batch for span in spans])
+            except Exception as e:
+                print(f"Error exporting spans: {str(e)}")
+
+    def export(self, spans):
+        raise NotImplementedError
+
+
+class JsonlExporter(_BackgroundExporter):
+    """One JSON object per span, appended to a file (or stdout for '-')"""
+
+    def __init__(self, path='-', **kwargs):
+        self.path = path
+        super().__init__(**kwargs)
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span) + '\n' for span in spans)
+        if self.path == '-':
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+        else:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+
+
+class OtlpHttpExporter(_BackgroundExporter):
+    """Sends spans to an OTLP/HTTP collector using the JSON encoding"""
+
+    def __init__(self, endpoint, service_name='crop-disease-detection', headers=None, **kwargs):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+        self.headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def _value(v):
+        if isinstance(v, bool):
+            return {'boolValue': v}
+        if isinstance(v, int):
+            return {'intValue': str(v)}
+        if isinstance(v, float):
+            return {'doubleValue': v}
+        return {'stringValue': str(v)}
+
+    def _attrs(self, attributes):
+        return [{'key': k, 'value': self._value(v)} for k, v in attributes.items()]
+
+    def export(self, spans):
+        body = {'resourceSpans': [{
+            'resource': {'attributes': self._attrs({'service.name': self.service_name})},
+            'scopeSpans': [{
+                'scope': {'name': 'crop-disease-detection.tracing'},
+                'spans': [{
+                    'traceId': s['trace_id'],
+                    'spanId': s['span_id'],
+                    'parentSpanId': s['parent_span_id'] or '',
+                    'name': s['name'],
+                    'kind': 1,
+                    'startTimeUnixNano': str(s['start_time_unix_nano']),
+                    'endTimeUnixNano': str(s['end_time_unix_nano']),
+                    'attributes': self._attrs(s['attributes']),
+                    'events': [{'name': e['name'], 'timeUnixNano': str(e['time_unix_nano']),
+                                'attributes': self._attrs(e['attributes'])} for e in s['events']],
+                    'status': {'code': 2 if s['status'] == 'ERROR' else 0},
+                } for s in spans],
+            }],
+        }]}
+        req = urllib.request.Request(self.url, data=json.dumps(body).encode(), headers=self.headers, method='POST')
+        urllib.request.urlopen(req, timeout=10).read()
+
+
+def exporter_from_config(kind, path='traces.jsonl', endpoint=None, service_name='crop-disease-detection'):
+    if kind in ('', 'none'):
+        return None
+    if kind == 'console':
+        return JsonlExporter('-')
+    if kind == 'jsonl':
+        return JsonlExporter(path)
+    if kind == 'otlp':
+        endpoint = endpoint or os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://localhost:4318')
+        return OtlpHttpExporter(endpoint, service_name=service_name)
+    raise ValueError(f'Unknown tracing exporter {kind!r}')
@@ -0,0 +1,170 @@
+"""Validation of uploaded files while they stream in.
+
+Werkzeug normally spools every file part over 500KB to a temporary file and
+leaves all checking to the view. Here each part is spooled in memory (the
+request as a whole is bounded by MAX_CONTENT_LENGTH) and checked chunk by
+chunk as it arrives: the first bytes must carry a known image signature
+(or an archive signature, on endpoints that take archives), image parts
+are capped in size, and as soon as the image header has arrived its
+dimensions are checked so decompression bombs are refused before any
+pixels are decoded.
+"""
+import io
+
+from flask import Request
+from PIL import Image
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+)
+ARCHIVE_SIGNATURES = (
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+# Enough for every image signature (WEBP is RIFF....WEBP); an uncompressed
+# tar is only recognisable by the 'ustar' magic at offset 257
+SNIFF_BYTES = 12
+TAR_SNIFF_BYTES = 262
+
+# The header is probed again every PROBE_STEP bytes until it parses, for at
+# most the first PROBE_LIMIT bytes (JPEG EXIF/ICC segments can be large)
+PROBE_STEP = 64 * 1024
+PROBE_LIMIT = 1024 * 1024
+
+
+def sniff(head, archives=False):
+    """('image', format) or ('archive', format) from a file's leading bytes, or None"""
+    for magic, fmt in IMAGE_SIGNATURES:
+        if head.startswith(magic):
+            return 'image', fmt
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image', 'WEBP'
+    if archives:
+        for magic, fmt in ARCHIVE_SIGNATURES:
+            if head.startswith(magic):
+                return 'archive', fmt
+        if head[257:262] == b'ustar':
+            return 'archive', 'tar'
+    return None
+
+
+def probe_size(data):
+    """(width, height) from the image header alone, or None if it hasn't fully arrived"""
+    try:
+        return Image.open(io.BytesIO(data)).size
+    except Image.DecompressionBombError as e:
+        raise RequestEntityTooLarge(f'Image resolution too large: {str(e)}')
+    except Exception:
+        return None
+
+
+def _check_pixels(size, max_pixels):
+    if size[0] * size[1] > max_pixels:
+        raise RequestEntityTooLarge(f'Image resolution {size[0]}x{size[1]} exceeds the limit of {max_pixels} pixels')
+
+
+def check_image(data, max_bytes, max_pixels):
+    """Reject `data` with 413/415 unless it is a readable image within the limits"""
+    if len(data) > max_bytes:
+        raise RequestEntityTooLarge(f'Image exceeds the limit of {max_bytes} bytes')
+    found = sniff(data[:SNIFF_BYTES])
+    if found is None:
+        raise UnsupportedMediaType('Upload is not a supported image (expected JPEG, PNG, GIF, BMP or WEBP)')
+    size = probe_size(data)
+    if size is None:
+        raise UnsupportedMediaType(f'Upload looks like {found[1]} but its header could not be read')
+    _check_pixels(size, max_pixels)
+
+
+class UploadGuard(io.BytesIO):
+    """In-memory spool for one uploaded file part that validates as it is written.
+
+    With strict=True a violation raises straight out of form parsing, so the
+    rest of the request body is never read. Otherwise the part is marked
+    with `error`, its bytes are dropped, and the remaining chunks are
+    discarded as they arrive, leaving the other parts of a batch usable.
+    """
+
+    def __init__(self, max_bytes, max_pixels, archives=False, strict=True):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.archives = archives
+        self.strict = strict
+        self.kind = None
+        self.format = None
+        self.size = None
+        self.error = None
+        self._probed_at = None
+
+    def write(self, b):
+        if self.error is not None:
+            return len(b)
+        n = super().write(b)
+        try:
+            self._check()
+        except HTTPException as e:
+            if self.strict:
+                raise
+            self.error = e
+            self.seek(0)
+            self.truncate()
+        return n
+
+    def _check(self):
+        length = self.tell()
+        if self.kind is None:
+            found = sniff(self.getvalue()[:TAR_SNIFF_BYTES], self.archives)
+            if found is None:
+                if length < (TAR_SNIFF_BYTES if self.archives else SNIFF_BYTES):
+                    return
+                raise UnsupportedMediaType('Upload is not a supported image (expected JPEG, PNG, GIF, BMP or WEBP)')
+            self.kind, self.format = found
+        if self.kind != 'image':
+            return
+        if length > self.max_bytes:
+            raise RequestEntityTooLarge(f'Image exceeds the limit of {self.max_bytes} bytes')
+        if self.size is None and length <= PROBE_LIMIT and (
+                self._probed_at is None or length - self._probed_at >= PROBE_STEP):
+            self._probed_at = length
+            self.size = probe_size(self.getvalue())
+            if self.size is not None:
+                _check_pixels(self.size, self.max_pixels)
+
+
+def read_image(storage, max_bytes, max_pixels):
+    """The bytes of an uploaded image part, validated; raises 413/415"""
+    stream = storage.stream
+    if isinstance(stream, UploadGuard):
+        if stream.error is not None:
+            raise stream.error
+        data = stream.getvalue()
+        if stream.kind == 'image' and stream.size is not None:
+            return data
+    else:
+        data = storage.read()
+    check_image(data, max_bytes, max_pixels)
+    return data
+
+
+def guarded_request_class(max_image_bytes, max_image_pixels, batch_endpoints=()):
+    """A Flask request class that spools file parts into UploadGuards.
+
+    Endpoints in `batch_endpoints` also accept archives and keep going past
+    a bad part; every other endpoint fails the whole request on the first.
+    """
+
+    class GuardedRequest(Request):
+        def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+            batch = self.endpoint in batch_endpoints
+            return UploadGuard(max_image_bytes, max_image_pixels, archives=batch, strict=not batch)
+
+    return GuardedRequest
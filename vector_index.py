@@ -0,0 +1,262 @@
+"""On-disk nearest-neighbour search over image embeddings.
+
+Vectors are L2-normalized and appended as float16 rows to a flat file that
+is memory-mapped for search, so millions of them cost disk space rather
+than RAM and only the rows actually compared are paged in. Case metadata
+(label, source) lives in a SQLite table keyed by row number.
+
+`build` adds an IVF index: a spherical k-means over a sample gives
+`nlist` centroids, and every row is filed under its nearest centroid. A
+query then scores only the rows of its `nprobe` nearest lists, plus any
+rows appended since the last build, instead of the whole store.
+"""
+import json
+import math
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from model_store import _file_lock
+
+# Rows scored per step, bounding the float32 copy made of float16 rows
+CHUNK_ROWS = 65536
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _merge_top(best_ids, best_scores, ids, scores, k):
+    """Running top-k: fold one chunk of (ids, scores) into the best so far"""
+    ids = np.concatenate([best_ids, ids])
+    scores = np.concatenate([best_scores, scores])
+    if len(scores) > k:
+        keep = np.argpartition(scores, -k)[-k:]
+        ids, scores = ids[keep], scores[keep]
+    return ids, scores
+
+
+def _assign(vectors, centroids):
+    """Nearest centroid (by cosine) of every row, a chunk at a time"""
+    out = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), CHUNK_ROWS):
+        out[i:i + CHUNK_ROWS] = (np.asarray(vectors[i:i + CHUNK_ROWS], dtype=np.float32) @ centroids.T).argmax(axis=1)
+    return out
+
+
+def kmeans(sample, nlist, iterations=10, seed=0):
+    """Spherical k-means: unit-length centroids maximizing cosine similarity"""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _assign(sample, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=nlist)
+        filled = np.nonzero(counts)[0]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0)
+        # Empty lists are reseeded from random rows rather than left unusable
+        empty = np.nonzero(counts == 0)[0]
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        centroids = normalize(centroids)
+    return centroids
+
+
+class VectorIndex:
+    """Append-only store of labelled embeddings with approximate k-NN search.
+
+    Safe to share between threads and between worker processes: appends
+    and builds take a file lock, and readers pick up new rows and new
+    index builds as they appear.
+    """
+
+    def __init__(self, directory, dim):
+        self.directory = directory
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, 'vectors.f16')
+        self.db_path = os.path.join(directory, 'cases.sqlite3')
+        self.index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._vectors = None
+        self._ivf = None
+        self._ivf_mtime = None
+        os.makedirs(directory, exist_ok=True)
+        with _file_lock(self._lock_path):
+            conn = sqlite3.connect(self.db_path)
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+                conn.execute('CREATE TABLE IF NOT EXISTS cases (id INTEGER PRIMARY KEY, label TEXT NOT NULL, '
+                             'source TEXT, added REAL NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS cases_label ON cases (label)')
+                conn.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (str(dim),))
+                conn.commit()
+                stored = int(dict(conn.execute('SELECT key, value FROM meta'))['dim'])
+            finally:
+                conn.close()
+        if stored != dim:
+            raise ValueError(f'Index at {directory} holds {stored}-d vectors, not {dim}-d')
+
+    @property
+    def _lock_path(self):
+        return os.path.join(self.directory, '.lock')
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.vectors_path) // (self.dim * 2)
+        except OSError:
+            return 0
+
+    def get_meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def add(self, vectors, labels, sources=None):
+        """Append labelled vectors; returns their ids"""
+        vectors = normalize(vectors).astype(np.float16)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f'Expected vectors of shape (n, {self.dim})')
+        sources = sources or [None] * len(vectors)
+        with self._lock, _file_lock(self._lock_path):
+            start = len(self)
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            now = time.time()
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?)',
+                                       [(start + i, label, source, now)
+                                        for i, (label, source) in enumerate(zip(labels, sources))])
+        return list(range(start, start + len(vectors)))
+
+    def _rows(self):
+        """The vector file memory-mapped, remapped when rows have been appended"""
+        count = len(self)
+        vectors = self._vectors
+        if vectors is None or len(vectors) != count:
+            with self._lock:
+                if count == 0:
+                    return np.empty((0, self.dim), dtype=np.float16)
+                vectors = self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r',
+                                                    shape=(count, self.dim))
+        return vectors
+
+    def _load_ivf(self):
+        """The current IVF build (reloaded when `build` replaces it), or None"""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._ivf_mtime:
+            with self._lock:
+                with open(self.index_path) as f:
+                    info = json.load(f)
+                path = os.path.join(self.directory, info['dir'])
+                self._ivf = {
+                    'indexed': info['indexed'],
+                    'centroids': np.load(os.path.join(path, 'centroids.npy')),
+                    'ids': np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+                    'offsets': np.load(os.path.join(path, 'offsets.npy')),
+                }
+                self._ivf_mtime = mtime
+        return self._ivf
+
+    def build(self, nlist=None, iterations=10, sample_size=None, seed=0):
+        """(Re)build the IVF index over every row stored so far; returns its nlist"""
+        with _file_lock(self._lock_path):
+            vectors = self._rows()
+            count = len(vectors)
+            if count == 0:
+                raise ValueError('Nothing to index')
+            nlist = min(count, nlist or max(1, int(round(math.sqrt(count)))))
+            rng = np.random.default_rng(seed)
+            sample_size = min(count, sample_size or max(nlist * 64, 10000))
+            rows = np.sort(rng.choice(count, sample_size, replace=False))
+            centroids = kmeans(np.asarray(vectors[rows], dtype=np.float32), nlist, iterations, seed)
+
+            assign = _assign(vectors, centroids)
+            # Ids are grouped by list and ascending within one, so a probe reads the file in order
+            ids = np.argsort(assign, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+
+            name = f'ivf-{count}-{os.getpid()}-{int(time.time())}'
+            path = os.path.join(self.directory, name)
+            os.makedirs(path)
+            np.save(os.path.join(path, 'centroids.npy'), centroids)
+            np.save(os.path.join(path, 'ids.npy'), ids)
+            np.save(os.path.join(path, 'offsets.npy'), offsets)
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'dir': name, 'indexed': count, 'nlist': nlist}, f)
+            os.replace(tmp, self.index_path)
+            # Earlier builds can still be mapped by readers in other processes;
+            # on POSIX removing them is safe, the pages stay until unmapped
+            for entry in os.listdir(self.directory):
+                if entry.startswith('ivf-') and entry != name:
+                    shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+        return nlist
+
+    def search(self, query, k=5, nprobe=8):
+        """The k stored rows most similar to `query` as (ids, cosine similarities), best first"""
+        q = normalize(query).reshape(-1)
+        vectors = self._rows()
+        count = len(vectors)
+        best_ids = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        ivf = self._load_ivf()
+
+        if ivf is None:
+            for i in range(0, count, CHUNK_ROWS):
+                scores = np.asarray(vectors[i:i + CHUNK_ROWS], dtype=np.float32) @ q
+                best_ids, best_scores = _merge_top(best_ids, best_scores,
+                                                   np.arange(i, i + len(scores)), scores, k)
+        else:
+            probe = np.argsort(ivf['centroids'] @ q)[::-1][:nprobe]
+            offsets = ivf['offsets']
+            candidates = np.sort(np.concatenate(
+                [ivf['ids'][offsets[c]:offsets[c + 1]] for c in probe] +
+                # Rows appended since the build are not in any list yet
+                [np.arange(ivf['indexed'], count)]))
+            for i in range(0, len(candidates), CHUNK_ROWS):
+                ids = candidates[i:i + CHUNK_ROWS]
+                scores = np.asarray(vectors[ids], dtype=np.float32) @ q
+                best_ids, best_scores = _merge_top(best_ids, best_scores, ids, scores, k)
+
+        order = np.argsort(best_scores)[::-1]
+        return best_ids[order], best_scores[order]
+
+    def cases(self, ids):
+        """{id: {'label', 'source', 'added'}} for the given ids"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        rows = self._conn.execute(
+            f'SELECT id, label, source, added FROM cases WHERE id IN ({",".join("?" * len(ids))})', ids)
+        return {row[0]: {'label': row[1], 'source': row[2], 'added': row[3]} for row in rows}
+
+    def stats(self):
+        ivf = self._load_ivf()
+        return {
+            'vectors': len(self),
+            'dim': self.dim,
+            'indexed': ivf['indexed'] if ivf else 0,
+            'nlist': len(ivf['centroids']) if ivf else 0,
+        }